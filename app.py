@@ -1,9 +1,19 @@
 import streamlit as st
 import pandas as pd
-import re
+import os
+import json
+import math
+import weakref
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
 from dotenv import load_dotenv
-from src.backend import BackendOrchestrator
-from src.gemini_client import GeminiClient
+from src.backend import (
+    BackendOrchestrator, DataFrameHistory, ResultCache, DatasetProfiler, FRAME_TYPES, trim_plan, split_plan_steps,
+)
+from src.lazy_dataset import LazyDataset
+from src.gemini_client import GeminiClient, PromptCache, LLMError
+from src.worker_pool import ExecutionPool, default_memory_limit_mb
+from src.batch_runner import build_plan
 
 load_dotenv()
 st.set_page_config(page_title="TCD - Data Assistant", layout="wide")
@@ -45,22 +55,100 @@ div.cell-sticky-toolbar {
 """, unsafe_allow_html=True)
 
 # --- Inicialização ---
+@st.cache_resource
+def get_execution_pool():
+    # Pool único por processo, compartilhado entre as sessões. TCD_WORKERS=0 desativa.
+    n_workers = int(os.getenv("TCD_WORKERS", "2"))
+    if n_workers <= 0: return None
+    # Limite de memória por worker: padrão metade da RAM; TCD_CELL_MEMORY_MB=0 desativa
+    mem = os.getenv("TCD_CELL_MEMORY_MB")
+    return ExecutionPool(
+        n_workers=n_workers,
+        timeout_s=int(os.getenv("TCD_CELL_TIMEOUT_S", "300")),
+        memory_limit_mb=(int(mem) or None) if mem else default_memory_limit_mb(),
+    )
+
+@st.cache_resource
+def get_prompt_cache():
+    return PromptCache(
+        max_entries=int(os.getenv("TCD_LLM_CACHE_ENTRIES", "5000")),
+        ttl_s=int(os.getenv("TCD_LLM_CACHE_TTL_S", str(7 * 24 * 3600))),
+    )
+
+@st.cache_resource
+def preinstall_kb_dependencies(_backend):
+    # Uma vez por processo: instala em background o que as funções da KB importam e falta. TCD_KB_PREINSTALL=1 liga.
+    missing = _backend.kb_missing_dependencies()
+    if not missing or os.getenv("TCD_KB_PREINSTALL", "0") != "1": return None
+    return _backend.install_libraries_async(missing)
+
 def init_state():
     if "backend" not in st.session_state:
         st.session_state.backend = BackendOrchestrator()
+        st.session_state.backend.pool = get_execution_pool()
+        st.session_state.backend.render_max_rows = int(os.getenv("TCD_RENDER_MAX_ROWS", "10000"))
+        st.session_state.backend.ingest_cache_mb = int(os.getenv("TCD_INGEST_CACHE_MB", "2048"))
+        # Leitura direta do disco só dentro desta pasta (servidor compartilhado)
+        st.session_state.backend.data_root = os.getenv("TCD_DATA_ROOT") or None
+        preinstall_kb_dependencies(st.session_state.backend)
     if "gemini" not in st.session_state:
-        st.session_state.gemini = GeminiClient()
+        st.session_state.gemini = GeminiClient(
+            cache=get_prompt_cache(),
+            prompt_budget_tokens=int(os.getenv("TCD_PROMPT_BUDGET_TOKENS", "6000")),
+            max_retries=int(os.getenv("TCD_LLM_MAX_RETRIES", "4")),
+        )
     if "df" not in st.session_state:
         st.session_state.df = None
     if "df_history" not in st.session_state:
-        st.session_state.df_history = []
+        st.session_state.df_history = DataFrameHistory()
+    if "result_cache" not in st.session_state:
+        st.session_state.result_cache = ResultCache(max_memory_mb=int(os.getenv("TCD_RESULT_CACHE_MB", "1024")))
     if "cells" not in st.session_state:
         st.session_state.cells = []
-    if "pending_install" not in st.session_state:
-        st.session_state.pending_install = None
+    if "pending_installs" not in st.session_state:
+        st.session_state.pending_installs = {}
+    if "session_uid" not in st.session_state:
+        st.session_state.session_uid = uuid.uuid4().hex
+    if "full_runs" not in st.session_state:
+        # Execuções em background: índice da célula -> {"run", "df", "preview"}
+        st.session_state.full_runs = {}
 
 init_state()
 
+def sync_profile():
+    # Perfil/metadados acompanham o df atual; o profiler só recalcula colunas alteradas
+    df = st.session_state.df
+    if df is None: return
+    ref = st.session_state.get("profile_ref")
+    if ref is not None and ref() is df: return
+    profile = st.session_state.backend.profile_dataset(df)
+    st.session_state.df_profile = profile
+    st.session_state.df_meta_llm = st.session_state.backend.generate_metadata(df, profile)
+    st.session_state.profile_ref = weakref.ref(df)
+
+def sync_installs():
+    # Instalações em background: copia o progresso para o log da célula e aplica o código ao terminar
+    # Chave = id da célula no plano atual: instalações de um plano/dataset anterior são descartadas
+    cells = {c['id']: c for c in st.session_state.cells}
+    for cell_id, p in list(st.session_state.pending_installs.items()):
+        cell = cells.get(cell_id)
+        if cell is None:
+            st.session_state.pending_installs.pop(cell_id, None)
+            continue
+        job = p.get("job")
+        if job is None: continue
+        new = job.logs[p["seen"]:]
+        p["seen"] += len(new)
+        cell['logs'].extend(f"📦 {line}" for line in new)
+        if job.status == "running": continue
+        if job.ok:
+            cell['error'] = None
+            cell['code'] = p['code']
+            cell['logs'].append(f"✅ Instalado: {', '.join(job.dists)}")
+            st.session_state.pending_installs.pop(cell_id, None)
+        else:
+            p.update(job=None, error=f"pip terminou com código {job.returncode}")
+
 # --- Helpers ---
 def get_log_html(logs):
     html = ""
@@ -72,84 +160,171 @@ def append_log_realtime(cell_index, message, placeholder):
     st.session_state.cells[cell_index]["logs"].append(message)
     placeholder.markdown(get_log_html(st.session_state.cells[cell_index]["logs"]), unsafe_allow_html=True)
 
+def fmt_mb(value):
+    return "-" if value is None else f"{value:.1f} MB"
+
+def perf_summary_frame(cells):
+    # Uma linha por célula perfilada; "% do tempo" aponta o passo a otimizar
+    rows = []
+    for i, c in enumerate(cells):
+        p = c.get('perf')
+        if not p: continue
+        rows.append({
+            "Passo": i + 1, "Descrição": c['step'][:60],
+            "Tempo (s)": p['wall_s'], "CPU (s)": p['cpu_s'], "Pico (MB)": p['peak_mb'],
+            "df entrada (MB)": p.get('df_in_mb'), "df saída (MB)": p.get('df_out_mb'),
+            "Linhas": f"{p.get('rows_in')} → {p.get('rows_out')}",
+            "Função mais cara": p['top'][0]['function'] if p.get('top') else "",
+        })
+    summary = pd.DataFrame(rows)
+    if not summary.empty:
+        summary.insert(3, "% do tempo", 100 * summary["Tempo (s)"] / summary["Tempo (s)"].sum())
+    return summary
+
+def render_perf(p):
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("Tempo", f"{p['wall_s']:.2f} s")
+    m2.metric("CPU", f"{p['cpu_s']:.2f} s")
+    m3.metric("Pico de memória", fmt_mb(p['peak_mb']))
+    m4.metric("df", f"{fmt_mb(p.get('df_in_mb'))} → {fmt_mb(p.get('df_out_mb'))}")
+    if p.get('top'):
+        st.dataframe(pd.DataFrame(p['top']), use_container_width=True, hide_index=True)
+
+RENDER_PAGE_ROWS = int(os.getenv("TCD_RENDER_PAGE_ROWS", "100"))
+
+def render_item(item, key):
+    # Itens já convertidos em execute_cached(render=True): o rerun só reenvia a página atual
+    kind = item["kind"]
+    if kind == "table":
+        table = item["table"]
+        pages = max(1, math.ceil(table.num_rows / RENDER_PAGE_ROWS))
+        page = st.number_input(f"Página (1-{pages})", 1, pages, 1, key=f"page_{key}") if pages > 1 else 1
+        st.dataframe(table.slice((page - 1) * RENDER_PAGE_ROWS, RENDER_PAGE_ROWS).to_pandas(), use_container_width=True)
+        if item["total_rows"] > RENDER_PAGE_ROWS:
+            capped = f" (exibição limitada às primeiras {table.num_rows:,})" if item["total_rows"] > table.num_rows else ""
+            st.caption(f"{item['total_rows']:,} linhas{capped}")
+    elif kind == "image": st.image(item["data"])
+    elif kind == "plotly":
+        import plotly.io as pio
+        st.plotly_chart(pio.from_json(item["json"]), use_container_width=True, key=f"plotly_{key}")
+    elif kind == "json": st.json(item["value"])
+    else: st.text(item["text"])
+
+def engine():
+    return st.session_state.get("engine", "pandas")
+
 # --- Callbacks ---
+def set_dataset(df, lease=None):
+    # O lease anterior (frame compartilhado entre sessões) é liberado
+    old_lease = st.session_state.get("dataset_lease")
+    st.session_state.dataset_lease = lease
+    if old_lease is not None: old_lease.release()
+    st.session_state.df = df
+    st.session_state.df_original = df
+    st.session_state.df_fp = None
+    st.session_state.df_history.reset(df)
+    st.session_state.cells = []
+    st.session_state.pending_installs = {}
+    st.session_state.raw_plan = ""
+
 def handle_upload():
     f = st.session_state.uploader
     if f:
         try:
-            df = pd.read_csv(f) if f.name.endswith('.csv') else pd.read_excel(f)
-            st.session_state.df = df
-            st.session_state.df_history = [df.copy()]
-            st.session_state.df_meta_llm = st.session_state.backend.generate_metadata(df)
-            st.session_state.cells = []
-            st.session_state.raw_plan = ""
+            data = f.getvalue()
+            sheets = st.session_state.backend.list_sheets(data, f.name)
+            st.session_state.sheet_names = sheets
+            sheet = st.session_state.get("sheet_selector")
+            if sheet not in sheets: sheet = sheets[0] if sheets else 0
+            if engine() == "arrow":
+                set_dataset(st.session_state.backend.load_lazy_dataset(data, f.name, sheet_name=sheet))
+            else:
+                # Frame compartilhado entre sessões (dedup por hash)
+                set_dataset(*st.session_state.backend.load_dataset_shared(data, f.name, sheet_name=sheet))
         except Exception as e:
             st.error(f"Erro arquivo: {e}")
 
+def handle_path():
+    # Motor arrow: arquivo/pasta local lido direto do disco, sem passar pelo upload
+    path = st.session_state.get("dataset_path", "").strip()
+    if not path: return
+    try:
+        st.session_state.sheet_names = []
+        set_dataset(st.session_state.backend.load_lazy_dataset(path=path))
+    except (PermissionError, FileNotFoundError) as e:
+        st.error(str(e))
+    except Exception as e:
+        st.error(f"Erro arquivo: {e}")
+
 def change_model():
     st.session_state.gemini.set_model(st.session_state.model_selector)
     st.toast(f"Modelo: {st.session_state.model_selector}")
 
+def toggle_llm_cache():
+    st.session_state.gemini.bypass_cache = st.session_state.bypass_llm_cache
+
+def toggle_profiling():
+    backend = st.session_state.backend
+    backend.profiling = st.session_state.profile_cells
+    backend.profile_top_n = int(st.session_state.get("profile_top_n", 0))
+
+def toggle_preview():
+    backend = st.session_state.backend
+    rows = st.session_state.get("preview_rows", os.getenv("TCD_PREVIEW_ROWS", "50000"))
+    backend.preview_rows = int(rows) if st.session_state.preview_mode else 0
+    backend.preview_strategy = st.session_state.get("preview_strategy", "stratified")
+
 def revert_last_step():
-    if len(st.session_state.df_history) > 1:
-        st.session_state.df_history.pop()
-        st.session_state.df = st.session_state.df_history[-1]
+    if st.session_state.df_history.can_undo():
+        st.session_state.df = st.session_state.df_history.undo()
+        st.session_state.df_fp = None
         st.toast("⏪ Desfeito!")
         st.rerun()
 
-def generate_plan():
+def generate_plan(stream_placeholder):
     if not st.session_state.get("objective") or st.session_state.df is None: return
     with st.spinner("Gerando plano..."):
-        raw_text = st.session_state.gemini.generate_initial_plan(
-            st.session_state.objective, st.session_state.df_meta_llm
-        )
-        match = re.search(r'(?m)^\s*1\..*', raw_text, re.DOTALL)
-        if match:
-            st.session_state.raw_plan = match.group(0)
-        else:
-            st.session_state.raw_plan = raw_text
+        try:
+            raw_text = st.session_state.gemini.generate_initial_plan(
+                st.session_state.objective, st.session_state.df_meta_llm,
+                on_chunk=lambda text: stream_placeholder.markdown(text),
+            )
+        except LLMError as e:
+            stream_placeholder.empty()
+            st.error(f"LLM indisponível ({e.attempts} tentativa(s)): {e}")
+            return
+        stream_placeholder.empty()
+        st.session_state.raw_plan = trim_plan(raw_text)
 
 def split_plan():
     raw = st.session_state.get("raw_plan_edit", "")
-    steps = [s.strip() for s in re.split(r'(?m)^\d+\.\s+', raw) if s.strip()]
+    steps = split_plan_steps(raw)
+    # id único por célula do plano: estado em background (instalações) não vaza para o próximo plano
+    st.session_state.pending_installs = {}
     st.session_state.cells = [{
-        "id": i, "step": s, "code": "", "output": None, "print_output": "",
-        "display_outputs": [], "error": None, "logs": [], "edit_mode": False 
-    } for i, s in enumerate(steps)]
+        "id": uuid.uuid4().hex, "step": s, "code": "", "output": None, "print_output": "",
+        "display_outputs": [], "error": None, "logs": [], "edit_mode": False, "perf": None, "preview": None
+    } for s in steps]
 
-def process_cell_generation(index, log_placeholder):
+def process_cell_generation(index, log_placeholder, code_placeholder):
     cell = st.session_state.cells[index]
     cell["logs"] = []
     
     append_log_realtime(index, "🚀 Iniciando geração...", log_placeholder)
     
     try:
-        append_log_realtime(index, "🔍 Selecionando KB...", log_placeholder)
-        kb_meta = st.session_state.backend.get_kb_metadata()
-        funcs = st.session_state.gemini.select_relevant_functions(cell['step'], kb_meta)
-        full_code = st.session_state.backend.get_specific_functions_code(funcs)
-        if funcs: append_log_realtime(index, f"📚 Funções: {', '.join(funcs)}", log_placeholder)
-        
-        append_log_realtime(index, "✍️ Escrevendo código...", log_placeholder)
-        draft = st.session_state.gemini.generate_final_code(
-            cell['step'], st.session_state.objective, st.session_state.df_meta_llm, full_code
+        final_code, missing = st.session_state.backend.generate_code_for_step(
+            st.session_state.gemini, cell['step'], st.session_state.objective, st.session_state.df_meta_llm,
+            log=lambda msg: append_log_realtime(index, msg, log_placeholder),
+            on_code=lambda code: code_placeholder.code(code, language='python'),
+            engine=engine(),
         )
         
-        append_log_realtime(index, "⚖️ Judge: Validando...", log_placeholder)
-        final_code = st.session_state.gemini.validate_code_safety(draft, cell['step'])
-        
-        # --- CORREÇÃO DE SEGURANÇA (Sintaxe Válida) ---
-        if "data = {" in final_code or "pd.DataFrame({" in final_code:
-            append_log_realtime(index, "⚠️ Mock removido.", log_placeholder)
-            # Substitui por dicionário vazio para não quebrar sintaxe do python
-            final_code = final_code.replace("data = {", "data = {} # Seguranca: Mock removed").replace("pd.DataFrame({", "pd.DataFrame({}) # Seguranca: Mock removed")
-
-        append_log_realtime(index, "📦 Checando deps...", log_placeholder)
-        missing = st.session_state.backend.check_missing_dependencies(final_code)
-        
-        if missing:
+        if not final_code:
+            append_log_realtime(index, "❌ Nenhum código aprovado pelo judge; gere a célula novamente.", log_placeholder)
+        elif missing:
             append_log_realtime(index, f"⚠️ Instalação Requerida: {missing}", log_placeholder)
-            st.session_state.pending_install = {"libs": missing, "index": index, "code": final_code}
+            st.session_state.pending_installs[cell['id']] = {"libs": missing, "code": final_code}
         else:
             st.session_state.cells[index]['code'] = final_code
             st.session_state.cells[index]['error'] = None
@@ -159,60 +334,218 @@ def process_cell_generation(index, log_placeholder):
         append_log_realtime(index, f"❌ Erro: {str(e)}", log_placeholder)
         st.error(str(e))
 
-def execute_cell(index):
-    code = st.session_state.cells[index]['code']
-    new_df, fig, err, captured_stdout, captured_displays = st.session_state.backend.execute_code(code, st.session_state.df)
-    
-    st.session_state.cells[index]['print_output'] = captured_stdout 
-    st.session_state.cells[index]['display_outputs'] = captured_displays
-    
+def generate_all_cells(progress_placeholder):
+    # Roda o pipeline de todas as células em paralelo (threads); as threads não chamam
+    # Streamlit, só escrevem nos logs de cada célula, que a thread principal renderiza
+    cells = st.session_state.cells
+    backend, gemini = st.session_state.backend, st.session_state.gemini
+    objective, meta, eng = st.session_state.objective, st.session_state.df_meta_llm, engine()
+
+    def worker(i):
+        cells[i]["logs"] = ["🚀 Iniciando geração..."]
+        try:
+            return backend.generate_code_for_step(gemini, cells[i]['step'], objective, meta, log=cells[i]["logs"].append, engine=eng)
+        except Exception as e:
+            cells[i]["logs"].append(f"❌ Erro: {str(e)}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=int(st.session_state.get("gen_concurrency", 4))) as ex:
+        futures = {ex.submit(worker, i): i for i in range(len(cells))}
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=0.3)
+            progress_placeholder.markdown(get_log_html(
+                [f"Passo {i+1}: {cells[i]['logs'][-1] if cells[i]['logs'] else '⏳'}" for i in range(len(cells))]
+            ), unsafe_allow_html=True)
+
+    for fut, i in futures.items():
+        result = fut.result()
+        # None: erro na geração; código vazio: descartado pelo judge (já registrado no log da célula)
+        if result is None or not result[0]: continue
+        final_code, missing = result
+        if missing:
+            cells[i]["logs"].append(f"⚠️ Instalação Requerida: {missing}")
+            st.session_state.pending_installs[cells[i]['id']] = {"libs": missing, "code": final_code}
+        else:
+            cells[i]['code'] = final_code
+            cells[i]['error'] = None
+            cells[i]["logs"].append("✅ Código pronto!")
+
+def apply_cell_result(index, r):
+    cell = st.session_state.cells[index]
+    cell['print_output'] = r['stdout']
+    rendered = r.get('rendered') or {}
+    cell['display_outputs'] = rendered.get('displays', [])
+
+    stats = r.get('stats') or st.session_state.backend.last_run_stats
+    # Resultado do cache mantém o perfil da execução que o gerou
+    if not r['cached']: cell['perf'] = stats.get("profile")
+    if r['cached']:
+        cell['logs'].append("♻️ Resultado servido do cache.")
+    elif stats.get("setup_s") is not None:
+        cell['logs'].append(
+            f"⏱️ Cold start {stats.get('cold_start_s', 0)*1000:.1f} ms | Setup {stats['setup_s']*1000:.1f} ms"
+            f" (cache={stats.get('compile_cache_hit')}) | Exec {stats.get('exec_s', 0)*1000:.0f} ms"
+        )
+
+    err = r['error']
     # --- TRATAMENTO DE DEPENDECIA EM RUNTIME ---
     if err and err.startswith("MissingDependency:"):
         missing_lib = err.split(":")[1]
         # Aciona o fluxo de instalação se der erro na execução
-        st.session_state.cells[index]['error'] = f"Falta biblioteca: {missing_lib}"
-        st.session_state.pending_install = {"libs": [missing_lib], "index": index, "code": code}
-        st.rerun()
+        cell['error'] = f"Falta biblioteca: {missing_lib}"
+        st.session_state.pending_installs[cell['id']] = {"libs": [missing_lib], "code": cell['code']}
     elif err:
-        st.session_state.cells[index]['error'] = err
+        cell['error'] = err
     else:
-        st.session_state.cells[index]['error'] = None
-        st.session_state.cells[index]['output'] = fig if fig else new_df
-        if isinstance(new_df, pd.DataFrame):
-            st.session_state.df = new_df
-            st.session_state.df_history.append(new_df.copy())
+        cell['error'] = None
+        cell['output'] = rendered.get('fig') or rendered.get('df')
+        for w in r.get('warnings', []): cell['logs'].append(f"⚠️ Prévia: {w}")
+        # Prévia não avança a cadeia: df e df_history só mudam com a execução completa
+        if isinstance(r['df'], FRAME_TYPES) and not r.get('preview'):
+            st.session_state.df = r['df']
+            st.session_state.df_fp = r['output_fp']
+            st.session_state.df_history.push(r['df'])
+
+def cell_task_id(index):
+    # Id da execução no pool: por sessão e célula, para o botão de cancelar
+    return f"{st.session_state.session_uid}:{index}"
+
+def cancel_cell(index):
+    entry = st.session_state.full_runs.get(index)
+    if entry and st.session_state.backend.cancel(entry["run"].task_id):
+        # O pool responde "Execução cancelada." em ~0.1 s; sync_full_runs aplica na célula
+        entry["run"].done.wait(5)
+
+def sync_full_runs():
+    # Execução em background terminou: aplica na célula (com prévia, substitui a prévia e só então grava no df_history)
+    cells = st.session_state.cells
+    for idx, entry in list(st.session_state.full_runs.items()):
+        run = entry["run"]
+        if not run.done.is_set(): continue
+        st.session_state.full_runs.pop(idx)
+        if idx >= len(cells) or cells[idx]['code'] != run.code: continue
+        cell = cells[idx]
+        if entry["df"]() is not st.session_state.df:
+            cell['logs'].append("⚠️ Execução descartada: o dataset mudou.")
+            continue
+        if entry["preview"]:
+            cell['preview'], cell['output'] = None, None
+            status = "❌ falhou" if run.result['error'] else "✅ concluída"
+            cell['logs'].append(f"{status}: execução completa em {run.elapsed_s:.1f} s")
+        apply_cell_result(idx, run.result)
+
+def wait_run(index, label):
+    # Espera com polling: o clique em "Cancelar" interrompe este script e cancel_cell encerra o worker
+    run = st.session_state.full_runs[index]["run"]
+    if st.session_state.backend.can_cancel:
+        st.button("⏹️ Cancelar", key=f"cancel_{index}_{id(run)}", on_click=cancel_cell, args=(index,))
+    status = st.empty()
+    while not run.done.wait(0.25):
+        status.caption(f"⏳ {label} ({run.elapsed_s:.0f} s)")
+    status.empty()
+
+def wait_full_runs():
+    # As células seguintes dependem do df completo dos passos anteriores
+    for idx in list(st.session_state.full_runs):
+        wait_run(idx, f"Aguardando execução completa do passo {idx + 1}")
+    sync_full_runs()
+
+def execute_cell(index):
+    wait_full_runs()
+    backend, df, cache = st.session_state.backend, st.session_state.df, st.session_state.result_cache
+    code = st.session_state.cells[index]['code']
+    fp = st.session_state.get("df_fp")
+    in_cache = fp is not None and ResultCache.make_key(code, fp) in cache
+    if backend.wants_preview(df) and not in_cache:
+        # Prévia na amostra; a execução completa só começa se ela passar (erros e correções iteram na amostra)
+        r = backend.execute_preview(code, df, render=True, task_id=cell_task_id(index))
+        cell = st.session_state.cells[index]
+        cell['logs'].append(f"🔎 Prévia em {r['sample_rows']} de {r['total_rows']} linhas")
+        apply_cell_result(index, r)
+        cell['preview'] = {"sample_rows": r['sample_rows'], "total_rows": r['total_rows']}
+        if r['error'] is None:
+            run = backend.start_full_run(code, df, cache, input_fp=fp, render=True, task_id=cell_task_id(index))
+            st.session_state.full_runs[index] = {"run": run, "df": weakref.ref(df), "preview": True}
+        st.rerun()
+    st.session_state.cells[index]['preview'] = None
+    # Também em background: assim a espera abaixo mantém o botão de cancelar clicável
+    run = backend.start_full_run(code, df, cache, input_fp=fp, render=True, task_id=cell_task_id(index))
+    st.session_state.full_runs[index] = {"run": run, "df": weakref.ref(df), "preview": False}
+    wait_run(index, f"Executando passo {index + 1}")
+    sync_full_runs()
     st.rerun()
 
-def fix_cell_code(index):
+def run_all_cells():
+    # Refaz a cadeia desde o dataset original; só reexecuta células com código ou entrada alterados
+    wait_full_runs()
+    base = st.session_state.df_original
+    st.session_state.df = base
+    st.session_state.df_fp = None
+    st.session_state.df_history.reset(base)
+    codes = [c['code'] for c in st.session_state.cells]
+    st.session_state.backend.run_cells(codes, base, st.session_state.result_cache, on_result=apply_cell_result, render=True)
+
+def fix_cell_code(index, code_placeholder):
     cell = st.session_state.cells[index]
-    fixed = st.session_state.gemini.generate_code_fix(cell['code'], cell['error'], cell['step'])
+    try:
+        fixed = st.session_state.gemini.generate_code_fix(
+            cell['code'], cell['error'], cell['step'],
+            on_code=lambda code: code_placeholder.code(code, language='python'),
+            engine=engine(),
+        )
+    except LLMError as e:
+        # Mantém o código atual; o erro da célula continua visível para nova tentativa
+        cell['logs'].append(f"❌ Correção falhou: {e}")
+        st.error(f"LLM indisponível ({e.attempts} tentativa(s)): {e}")
+        return
+    m = st.session_state.gemini.last_metrics()
+    if m: cell['logs'].append(f"⏱️ fix: ~{m['prompt_tokens']} tokens | TTFT {m['ttft_s']:.2f}s | total {m['total_s']:.2f}s")
     st.session_state.cells[index]['code'] = fixed
     st.toast("Código corrigido!")
 
 def toggle_edit_mode(index):
     st.session_state.cells[index]['edit_mode'] = not st.session_state.cells[index]['edit_mode']
 
-def confirm_install():
-    p = st.session_state.pending_install
-    if p:
-        ok, msg = st.session_state.backend.install_libraries(p['libs'])
-        if ok:
-            # Se for instalação via erro de execução, limpamos o erro
-            idx = p['index']
-            st.session_state.cells[idx]['error'] = None
-            
-            st.session_state.cells[idx]['code'] = p['code']
-            st.session_state.pending_install = None
-            st.rerun()
-        else:
-            st.error(msg)
+def confirm_install(cell_id):
+    p = st.session_state.pending_installs.get(cell_id)
+    if p and p.get("job") is None:
+        # Roda em background; sync_installs acompanha o log e aplica o código quando terminar
+        p.update(job=st.session_state.backend.install_libraries_async(p['libs']), seen=0, error=None)
+
+sync_profile()
+sync_installs()
+sync_full_runs()
 
 # --- UI ---
 with st.sidebar:
     st.title("Configurações")
     st.selectbox("Modelo", ["gemini-2.5-flash", "gemini-2.5-pro", "gemini-2.5-flash-lite"], 
                  key="model_selector", on_change=change_model)
+    st.checkbox("🔄 Forçar regeneração (ignorar cache do LLM)", key="bypass_llm_cache", on_change=toggle_llm_cache)
+    cache_stats = get_prompt_cache().stats()
+    st.caption(f"Cache LLM: {cache_stats['hits']} hits / {cache_stats['misses']} misses")
+    kb_missing = st.session_state.backend.kb_missing_dependencies()
+    if kb_missing: st.caption(f"📦 Pacotes da KB ausentes: {', '.join(kb_missing)}")
+    st.selectbox("Motor de dados", ["pandas", "arrow"], key="engine", on_change=handle_upload,
+                 help="arrow: dataset fora da memória (Parquet em disco); filtros e agregações rodam em streaming")
     st.file_uploader("Dataset", key="uploader", on_change=handle_upload)
+    if engine() == "arrow" and st.session_state.backend.data_root:
+        st.text_input("Caminho local (arquivos grandes)", key="dataset_path", on_change=handle_path,
+                      placeholder="extrato.csv ou pasta Parquet", help=f"Relativo a {st.session_state.backend.data_root}")
+    if len(st.session_state.get("sheet_names", [])) > 1:
+        st.selectbox("Planilha", st.session_state.sheet_names, key="sheet_selector", on_change=handle_upload)
+    st.checkbox("⏱️ Perfilar células", key="profile_cells", on_change=toggle_profiling,
+                help="Tempo, CPU e pico de memória por célula (deixa a execução um pouco mais lenta)")
+    if st.session_state.get("profile_cells"):
+        st.number_input("Top funções (cProfile, 0 = desligado)", min_value=0, max_value=50, value=0,
+                        key="profile_top_n", on_change=toggle_profiling)
+    st.checkbox("🔎 Prévia em amostra", key="preview_mode", on_change=toggle_preview,
+                help="Datasets grandes: a célula roda antes numa amostra (erros em segundos) e a execução completa segue em background")
+    if st.session_state.get("preview_mode"):
+        st.number_input("Linhas da amostra", min_value=1_000, step=10_000, value=int(os.getenv("TCD_PREVIEW_ROWS", "50000")),
+                        key="preview_rows", on_change=toggle_preview)
+        st.selectbox("Amostragem", ["stratified", "head"], key="preview_strategy", on_change=toggle_preview)
     st.button("⏪ Desfazer Ação", on_click=revert_last_step, disabled=len(st.session_state.df_history)<=1)
 
 st.title("Assistente de Análise 🤖")
@@ -221,14 +554,19 @@ if st.session_state.df is not None:
     with st.expander(f"📊 Explorador de Dados (Shape: {st.session_state.df.shape})", expanded=True):
         tab1, tab2, tab3 = st.tabs(["📋 Amostra", "📈 Estatísticas", "ℹ️ Estrutura"])
         with tab1: st.dataframe(st.session_state.df.head(), use_container_width=True)
-        with tab2: st.dataframe(st.session_state.df.describe(), use_container_width=True)
+        if isinstance(st.session_state.df, LazyDataset):
+            st.caption("Motor arrow: estatísticas calculadas em streaming sobre o arquivo em disco.")
+        with tab2:
+            st.dataframe(DatasetProfiler.describe_frame(st.session_state.df_profile), use_container_width=True)
+            if any(c.get("approx") for c in st.session_state.df_profile["columns"].values()):
+                st.caption("Quantis, desvio e cardinalidade aproximados por amostragem.")
         with tab3:
-            info_df = pd.DataFrame({"Tipo": st.session_state.df.dtypes.astype(str), "Nulos": st.session_state.df.isnull().sum()})
-            st.dataframe(info_df, use_container_width=True)
+            st.dataframe(DatasetProfiler.info_frame(st.session_state.df_profile), use_container_width=True)
 
     st.divider()
     st.text_area("Objetivo", key="objective", placeholder="Ex: Analisar dados...")
-    if st.button("Gerar Plano", type="primary"): generate_plan()
+    plan_stream_ph = st.empty()
+    if st.button("Gerar Plano", type="primary"): generate_plan(plan_stream_ph)
 
     if st.session_state.get("raw_plan"):
         with st.expander("📝 Editar Plano Bruto", expanded=False):
@@ -239,6 +577,26 @@ if st.session_state.df is not None:
 # Loop de Células
 if st.session_state.cells:
     st.divider()
+    c_gen_all, c_run_all, c_conc = st.columns([2, 2, 3])
+    with c_conc: st.number_input("Concorrência", min_value=1, max_value=16, value=4, key="gen_concurrency")
+    with c_run_all: st.button("⏩ Rodar Tudo", on_click=run_all_cells, disabled=not any(c['code'] for c in st.session_state.cells))
+    st.download_button(
+        "💾 Salvar Plano (JSON)", file_name="plano.json", mime="application/json",
+        data=json.dumps(build_plan(st.session_state.get("objective", ""), st.session_state.cells,
+                                   st.session_state.gemini.model_name), ensure_ascii=False, indent=2),
+        help="Use com `python -m src.batch_runner run` para executar em lote",
+    )
+    perf_summary = perf_summary_frame(st.session_state.cells)
+    if not perf_summary.empty:
+        with st.expander("⏱️ Performance por Passo", expanded=False):
+            st.dataframe(perf_summary, use_container_width=True, hide_index=True)
+            slowest = perf_summary.loc[perf_summary["Tempo (s)"].idxmax()]
+            st.caption(f"🐢 Passo mais lento: {slowest['Passo']} ({slowest['Tempo (s)']:.2f} s, {slowest['% do tempo']:.0f}% do total)")
+    gen_all_ph = st.empty()
+    with c_gen_all:
+        if st.button("🎲 Gerar Todas", type="primary"):
+            generate_all_cells(gen_all_ph)
+            st.rerun()
     for i, cell in enumerate(st.session_state.cells):
         
         # Sticky Header
@@ -248,10 +606,12 @@ if st.session_state.cells:
         
         log_ph = st.empty()
         if cell['logs']: log_ph.markdown(get_log_html(cell['logs']), unsafe_allow_html=True)
+        # Código parcial durante o streaming do LLM
+        stream_ph = st.empty()
 
         with c_b1:
             if st.button("🎲 Gerar", key=f"gen_{i}", use_container_width=True):
-                process_cell_generation(i, log_ph)
+                process_cell_generation(i, log_ph, stream_ph)
                 st.rerun()
         with c_b2:
             if st.button("▶️ Rodar", key=f"run_{i}", disabled=not cell['code'], type="primary", use_container_width=True):
@@ -259,7 +619,7 @@ if st.session_state.cells:
         with c_b3:
              if cell.get('error'):
                 if st.button("🔧 Corrigir", key=f"fix_{i}", type="secondary", use_container_width=True):
-                    fix_cell_code(i)
+                    fix_cell_code(i, stream_ph)
                     st.rerun()
         st.markdown('</div>', unsafe_allow_html=True)
 
@@ -270,12 +630,19 @@ if st.session_state.cells:
              if new_step != cell['step']: st.session_state.cells[i]['step'] = new_step
 
         # --- INSTALAÇÃO PENDENTE (Renderizado DENTRO da célula correta) ---
-        if st.session_state.pending_install and st.session_state.pending_install['index'] == i:
+        if cell['id'] in st.session_state.pending_installs:
+            p = st.session_state.pending_installs[cell['id']]
             with st.container(border=True):
-                st.error(f"⚠️ Instalação Necessária: {', '.join(st.session_state.pending_install['libs'])}")
-                c1, c2 = st.columns(2)
-                c1.button("✅ Sim, Instalar", on_click=confirm_install, key=f"inst_yes_{i}")
-                c2.button("❌ Não", on_click=lambda: st.session_state.pop("pending_install"), key=f"inst_no_{i}")
+                if p.get("job") is not None:
+                    # As outras células seguem utilizáveis; o progresso aparece no log desta
+                    st.info(f"📦 Instalando em background: {', '.join(p['job'].dists)}")
+                    st.button("🔄 Atualizar", key=f"inst_ref_{i}")
+                else:
+                    if p.get("error"): st.error(f"❌ Falha na instalação ({p['error']}); veja o log.")
+                    st.error(f"⚠️ Instalação Necessária: {', '.join(p['libs'])}")
+                    c1, c2 = st.columns(2)
+                    c1.button("✅ Sim, Instalar", on_click=confirm_install, args=(cell['id'],), key=f"inst_yes_{i}")
+                    c2.button("❌ Não", on_click=lambda cid=cell['id']: st.session_state.pending_installs.pop(cid, None), key=f"inst_no_{i}")
 
         # 2. Código
         if cell['code']:
@@ -293,26 +660,41 @@ if st.session_state.cells:
                 else:
                     st.code(cell['code'], language='python')
 
+        if i in st.session_state.full_runs:
+            run = st.session_state.full_runs[i]["run"]
+            pv = cell.get('preview') or {}
+            if st.session_state.full_runs[i]["preview"]:
+                st.info(f"🔎 Prévia em {pv.get('sample_rows')} de {pv.get('total_rows')} linhas; execução completa em andamento ({run.elapsed_s:.0f} s)")
+            else:
+                st.info(f"⏳ Execução em andamento ({run.elapsed_s:.0f} s)")
+            c_ref, c_cancel = st.columns(2)
+            c_ref.button("🔄 Atualizar", key=f"full_ref_{i}")
+            if st.session_state.backend.can_cancel:
+                c_cancel.button("⏹️ Cancelar", key=f"full_cancel_{i}", on_click=cancel_cell, args=(i,))
+        elif cell.get('preview'):
+            st.caption(f"🔎 Resultado da prévia ({cell['preview']['sample_rows']} linhas da amostra)")
+
         # 3. Erro
         if cell.get('error'):
             st.error(f"Erro:\n{cell['error']}")
 
         # 4. Resultados
-        has_out = cell.get('output') is not None or cell.get('display_outputs') or (cell.get('print_output') and not cell.get('error'))
+        has_out = cell.get('output') is not None or cell.get('display_outputs') or (cell.get('print_output') and not cell.get('error')) or cell.get('perf')
         if has_out:
             st.markdown("### Resultado")
             
-            if cell.get('display_outputs'):
-                for obj in cell['display_outputs']:
-                    if isinstance(obj, (pd.DataFrame, pd.Series)): st.dataframe(obj, use_container_width=True)
-                    else: st.write(obj)
+            for j, item in enumerate(cell.get('display_outputs') or []):
+                render_item(item, f"{i}_d{j}")
 
             if cell.get('print_output'):
                 with st.expander("Console Output (Prints)", expanded=False):
                     st.markdown(f'<div class="print-box">{cell["print_output"]}</div>', unsafe_allow_html=True)
 
-            out = cell['output']
-            if isinstance(out, pd.DataFrame): st.dataframe(out, use_container_width=True)
-            elif out: st.pyplot(out)
+            if cell.get('perf'):
+                with st.expander("⏱️ Performance", expanded=False):
+                    render_perf(cell['perf'])
+
+            if cell.get('output') is not None:
+                render_item(cell['output'], f"{i}_out")
                 
         st.markdown("---")
\ No newline at end of file
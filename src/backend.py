@@ -1,20 +1,1241 @@
 import pandas as pd
+import numpy as np
 import json
 import logging
 import io
+import os
 import ast
+import hashlib
+import uuid
+import pickle
+import shutil
 import sys
 import subprocess
+import importlib
 import importlib.util
+import time
+import math
+import re
+import unicodedata
+import builtins
+import types
+import __future__
+import threading
+import weakref
+from collections import OrderedDict
 from contextlib import redirect_stdout
 
+from src.lazy_dataset import LazyDataset, open_dataset
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Copy-on-write: cópias rasas de df são seguras e colunas não alteradas
+# são compartilhadas entre passos (base do histórico por deltas). No pandas 3 é sempre ativo
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+# Tipos que seguem adiante na cadeia de células como o `df` da sessão
+FRAME_TYPES = (pd.DataFrame, LazyDataset)
+
+
+def _shallow(df):
+    # LazyDataset é imutável; DataFrame com CoW: cópia rasa isola sem duplicar memória
+    return df if isinstance(df, LazyDataset) else df.copy(deep=False)
+
+
+def _same_column(a, b):
+    if a.dtype != b.dtype or len(a) != len(b): return False
+    try:
+        va, vb = a.to_numpy(copy=False), b.to_numpy(copy=False)
+        # Mesmo buffer (coluna compartilhada via CoW): igual sem comparar valores
+        if va.__array_interface__["data"] == vb.__array_interface__["data"] and va.strides == vb.strides:
+            return True
+    except Exception: pass
+    return a.equals(b)
+
+
+class DataFrameHistory:
+    """
+    Histórico de desfazer baseado em deltas por coluna.
+    Para cada passo guarda apenas o necessário para reconstruir o frame anterior
+    a partir do atual (colunas alteradas/removidas + ordem das colunas). Quando o
+    índice muda, guarda o frame anterior inteiro. Entradas antigas são despejadas
+    para disco quando o total em memória passa de `max_memory_mb`.
+    """
+    def __init__(self, max_memory_mb=512, max_steps=50, spill_dir=".cache/history"):
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024
+        self.max_steps = max_steps
+        self.spill_dir = os.path.join(spill_dir, uuid.uuid4().hex)
+        self.current = None
+        self.entries = []
+        # Sessão encerrada (histórico coletado): o diretório de despejo sai junto
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+
+    def __len__(self):
+        # Número de estados disponíveis (compatível com a antiga lista df_history)
+        return 0 if self.current is None else len(self.entries) + 1
+
+    def can_undo(self):
+        return len(self.entries) > 0
+
+    def memory_usage(self):
+        return sum(e["nbytes"] for e in self.entries if e["path"] is None)
+
+    def reset(self, df):
+        self.clear()
+        self.current = df
+        return self
+
+    def clear(self):
+        self.current = None
+        self.entries = []
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def push(self, new_df):
+        prev = self.current
+        if prev is None:
+            self.current = new_df
+            return
+        entry = self._make_delta(prev, new_df)
+        self.entries.append(entry)
+        self.current = new_df
+        logger.info(f"Histórico: passo {len(self.entries)} ({entry['kind']}, {entry['nbytes'] / 1e6:.1f} MB)")
+
+        if len(self.entries) > self.max_steps:
+            self._discard(self.entries.pop(0))
+        self._enforce_budget()
+
+    def undo(self):
+        if not self.entries: return self.current
+        entry = self.entries.pop()
+        data = self._load(entry)
+        if entry["kind"] == "full":
+            prev = data
+        else:
+            cur = self.current
+            cols = {c: (data[c] if c in data else cur[c]) for c in entry["columns"]}
+            prev = pd.DataFrame({c: s.array for c, s in cols.items()}, index=cur.index)
+            prev.columns = entry["columns"]
+        self.current = prev
+        return prev
+
+    def _make_delta(self, prev, new):
+        if not (isinstance(prev, pd.DataFrame) and isinstance(new, pd.DataFrame)):
+            # Motor fora da memória: LazyDataset é só uma visão imutável, guarda a referência
+            data = _shallow(prev)
+            return {"kind": "full", "columns": None, "data": data,
+                    "nbytes": int(data.memory_usage(deep=True).sum()) if isinstance(data, pd.DataFrame) else 0, "path": None}
+        # identical (não equals): nome e dtype do índice também precisam voltar no undo
+        delta_ok = (
+            prev.index.identical(new.index)
+            and prev.columns.is_unique and new.columns.is_unique
+        )
+        if not delta_ok:
+            # Com CoW a cópia rasa basta: o frame anterior não é mais alterado
+            data = _shallow(prev)
+            return {"kind": "full", "columns": prev.columns, "data": data,
+                    "nbytes": int(data.memory_usage(deep=True).sum()), "path": None}
+
+        data = {}
+        for c in prev.columns:
+            if c not in new.columns or not _same_column(prev[c], new[c]):
+                # Cópia explícita: uma view manteria vivo o bloco inteiro do frame anterior
+                data[c] = prev[c].copy()
+        # deep=True: em colunas object/string o raso conta só os ponteiros
+        nbytes = int(sum(s.memory_usage(deep=True, index=False) for s in data.values()))
+        return {"kind": "delta", "columns": prev.columns, "data": data, "nbytes": nbytes, "path": None}
+
+    def _enforce_budget(self):
+        # Despeja as entradas mais antigas primeiro; a mais recente fica em memória (undo rápido)
+        for entry in self.entries[:-1]:
+            if self.memory_usage() <= self.max_memory_bytes: break
+            if entry["path"] is None: self._spill(entry)
+
+    def _spill(self, entry):
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            path = os.path.join(self.spill_dir, f"{uuid.uuid4().hex}.pkl")
+            with open(path, "wb") as f:
+                pickle.dump(entry["data"], f, protocol=pickle.HIGHEST_PROTOCOL)
+            entry["data"], entry["path"] = None, path
+        except Exception as e:
+            logger.warning(f"Falha ao despejar histórico em disco: {e}")
+
+    def _load(self, entry):
+        if entry["path"] is None: return entry["data"]
+        with open(entry["path"], "rb") as f: data = pickle.load(f)
+        self._discard(entry)
+        return data
+
+    def _discard(self, entry):
+        if entry["path"]:
+            try: os.remove(entry["path"])
+            except OSError: pass
+
+
+def frame_fingerprint(df):
+    """Hash do conteúdo de um frame (valores, índice, colunas e dtypes)."""
+    h = hashlib.sha256()
+    if isinstance(df, LazyDataset):
+        return df.fingerprint()
+    try:
+        if isinstance(df, pd.DataFrame):
+            h.update(repr((list(df.columns), [str(t) for t in df.dtypes], df.shape)).encode("utf-8"))
+        h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    except Exception:
+        # Valores não hasheáveis (listas, dicts em colunas object)
+        h.update(pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL))
+    return h.hexdigest()
+
+
+def trim_plan(raw_text):
+    # Descarta a introdução do modelo: o plano começa no item "1."
+    match = re.search(r'(?m)^\s*1\..*', raw_text, re.DOTALL)
+    return match.group(0) if match else raw_text
+
+
+def split_plan_steps(raw_plan):
+    return [s.strip() for s in re.split(r'(?m)^\d+\.\s+', raw_plan) if s.strip()]
+
+
+class DatasetProfiler:
+    """
+    Perfil por coluna com cache pelo hash do conteúdo da coluna: após um passo só as
+    colunas novas/alteradas são recalculadas. Acima de `sample_threshold` linhas, quantis,
+    desvio e cardinalidade vêm de uma amostra (marcados como aproximados); contagens,
+    nulos, média, mínimo e máximo continuam exatos.
+    """
+    def __init__(self, sample_threshold=200_000, sample_size=100_000, max_entries=2048):
+        self.sample_threshold = sample_threshold
+        self.sample_size = sample_size
+        self.max_entries = max_entries
+        self._stats = OrderedDict()
+
+    @staticmethod
+    def _column_key(name, s):
+        # Hash dos buffers brutos quando possível (numpy/Arrow): bem mais barato que
+        # recalcular as estatísticas; hash_pandas_object só para colunas object
+        h = hashlib.sha256(f"{name}|{s.dtype}|{len(s)}".encode("utf-8"))
+        pa_array = getattr(s.array, "_pa_array", None)
+        try:
+            if pa_array is not None:
+                for chunk in getattr(pa_array, "chunks", [pa_array]):
+                    h.update(f"{chunk.offset}:{len(chunk)}".encode())
+                    for buf in chunk.buffers():
+                        if buf is not None: h.update(buf)
+            elif isinstance(s.dtype, np.dtype) and s.dtype != object:
+                h.update(np.ascontiguousarray(s.to_numpy(copy=False)).tobytes())
+            else:
+                h.update(pd.util.hash_pandas_object(s, index=False).to_numpy().tobytes())
+        except Exception:
+            h.update(pickle.dumps(s.to_numpy(), protocol=pickle.HIGHEST_PROTOCOL))
+        return h.hexdigest()
+
+    def _column_stats(self, s):
+        n = len(s)
+        nulls = int(s.isna().sum())
+        stats = {"dtype": str(s.dtype), "count": n - nulls, "nulls": nulls, "approx": False}
+        sample = s
+        if n > self.sample_threshold:
+            sample = s.sample(self.sample_size, random_state=0)
+            stats["approx"] = True
+
+        if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+            q = sample.quantile([0.25, 0.5, 0.75])
+            stats.update({
+                "kind": "numeric", "mean": s.mean(), "std": sample.std(), "min": s.min(),
+                "25%": q.loc[0.25], "50%": q.loc[0.5], "75%": q.loc[0.75], "max": s.max(),
+            })
+        elif pd.api.types.is_datetime64_any_dtype(s):
+            stats.update({"kind": "datetime", "min": s.min(), "max": s.max()})
+        else:
+            try:
+                vc = sample.value_counts()
+                stats.update({
+                    "kind": "categorical", "unique": int(len(vc)),
+                    "top": vc.index[0] if len(vc) else None, "freq": int(vc.iloc[0]) if len(vc) else 0,
+                })
+            except TypeError:
+                # Valores não hasheáveis (listas/dicts)
+                stats.update({"kind": "object"})
+        return stats
+
+    def profile(self, df):
+        columns = {}
+        for name in df.columns:
+            s = df[name]
+            if isinstance(s, pd.DataFrame): s = s.iloc[:, 0]  # nomes de coluna duplicados
+            key = self._column_key(name, s)
+            if key in self._stats:
+                self._stats.move_to_end(key)
+            else:
+                self._stats[key] = self._column_stats(s)
+                if len(self._stats) > self.max_entries: self._stats.popitem(last=False)
+            columns[name] = self._stats[key]
+        return {"shape": df.shape, "columns": columns}
+
+    @staticmethod
+    def describe_frame(profile):
+        """Equivalente a df.describe() (colunas numéricas) a partir do perfil."""
+        rows = ["count", "mean", "std", "min", "25%", "50%", "75%", "max"]
+        data = {c: [st.get(r) for r in rows] for c, st in profile["columns"].items() if st.get("kind") == "numeric"}
+        return pd.DataFrame(data, index=rows)
+
+    @staticmethod
+    def info_frame(profile):
+        cols = profile["columns"]
+        return pd.DataFrame({
+            "Tipo": [st["dtype"] for st in cols.values()],
+            "Nulos": [st["nulls"] for st in cols.values()],
+        }, index=list(cols.keys()))
+
+    @staticmethod
+    def summarize_column(st):
+        def fmt(v):
+            return f"{v:.4g}" if isinstance(v, (float, np.floating)) else str(v)
+        approx = "~" if st.get("approx") else ""
+        if st.get("kind") == "numeric":
+            return f"mean={fmt(st['mean'])}, std{approx}={fmt(st['std'])}, min={fmt(st['min'])}, mediana{approx}={fmt(st['50%'])}, max={fmt(st['max'])}"
+        if st.get("kind") == "datetime":
+            return f"min={st['min']}, max={st['max']}"
+        if st.get("kind") == "categorical":
+            return f"únicos{approx}={st['unique']}, top={str(st['top'])[:40]!r} ({st['freq']})"
+        return "objetos"
+
+
+def _result_nbytes(result):
+    # Frames de saída (sem deep: o custo de medir object seria o de uma cópia) + itens renderizados
+    total = 0
+    for obj in (result.get("df"), *(result.get("displays") or [])):
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            total += int(obj.memory_usage(index=True, deep=False).sum())
+    for item in (result.get("rendered") or {}).get("displays", []) + [
+            (result.get("rendered") or {}).get("fig"), (result.get("rendered") or {}).get("df")]:
+        if not item: continue
+        if item["kind"] == "table": total += item["table"].nbytes
+        elif item["kind"] == "image": total += len(item["data"])
+        elif item["kind"] in ("plotly", "text"): total += len(item.get("json") or item.get("text") or "")
+    return total
+
+
+class ResultCache:
+    """
+    Cache LRU de resultados de células, endereçado por hash do código + fingerprint do df
+    de entrada. Limitado por número de entradas e por bytes (frames de saída e itens
+    renderizados): resultados maiores que o orçamento inteiro não são guardados.
+    """
+    def __init__(self, max_entries=64, max_memory_mb=1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_memory_mb * 1024 * 1024
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(code_str, input_fp):
+        return hashlib.sha256(f"{input_fp}\n{code_str}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, result):
+        size = _result_nbytes(result)
+        self._evict(key)
+        if size > self.max_bytes: return
+        self._entries[key] = result
+        self._sizes[key] = size
+        self.nbytes += size
+        while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, key):
+        if self._entries.pop(key, None) is not None: self.nbytes -= self._sizes.pop(key)
+
+    def __contains__(self, key):
+        # Consulta sem contar hit/miss nem mexer na ordem LRU
+        return key in self._entries
+
+    def clear(self):
+        self._entries.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+
+def _frame_mb(df):
+    if not isinstance(df, pd.DataFrame): return None
+    try: return float(df.memory_usage(index=True, deep=True).sum()) / 1024 ** 2
+    except Exception: return None
+
+
+class CellProfiler:
+    """
+    Perfil opcional de uma execução: tempo de parede e de CPU, pico de memória alocada
+    (tracemalloc), tamanho do df antes/depois e, com top_n > 0, as funções mais caras
+    pelo cProfile. tracemalloc e cProfile deixam a célula mais lenta; só ligar quando pedido.
+    """
+    def __init__(self, top_n=0):
+        self.top_n = top_n
+        self._prof = None
+        self._own_trace = False
+
+    def start(self, df):
+        import tracemalloc
+        self.result = {"rows_in": len(df) if isinstance(df, pd.DataFrame) else None, "df_in_mb": _frame_mb(df)}
+        self._own_trace = not tracemalloc.is_tracing()
+        if self._own_trace: tracemalloc.start()
+        tracemalloc.reset_peak()
+        self._mem0 = tracemalloc.get_traced_memory()[0]
+        if self.top_n:
+            import cProfile
+            try:
+                self._prof = cProfile.Profile()
+                self._prof.enable()
+            except ValueError:
+                # Outro profiler já ativo no processo
+                self._prof = None
+        self._cpu0, self._wall0 = time.process_time(), time.perf_counter()
+
+    def stop(self):
+        import tracemalloc
+        wall, cpu = time.perf_counter() - self._wall0, time.process_time() - self._cpu0
+        if self._prof is not None: self._prof.disable()
+        peak = tracemalloc.get_traced_memory()[1] - self._mem0
+        if self._own_trace: tracemalloc.stop()
+        self.result.update(wall_s=wall, cpu_s=cpu, peak_mb=max(peak, 0) / 1024 ** 2, top=self._top())
+        return self.result
+
+    def finish(self, res_df):
+        self.result.update(rows_out=len(res_df) if isinstance(res_df, pd.DataFrame) else None, df_out_mb=_frame_mb(res_df))
+        return self.result
+
+    def _top(self):
+        if self._prof is None: return []
+        import pstats
+        rows = []
+        for (file, line, func), (_, ncalls, tottime, cumtime, _) in pstats.Stats(self._prof).stats.items():
+            # O exec e o corpo da célula acumulam tudo; não dizem onde está o custo
+            if func == "<built-in method builtins.exec>" or (file == "<celula>" and func == "<module>"): continue
+            name = f"{os.path.basename(file)}:{line}({func})" if line else func
+            rows.append({"function": name, "ncalls": ncalls, "tottime_s": tottime, "cumtime_s": cumtime})
+        rows.sort(key=lambda r: r["cumtime_s"], reverse=True)
+        return rows[:self.top_n]
+
+
+def arrow_table(df, preserve_index=True):
+    """pa.Table de um DataFrame; colunas object com tipos mistos (ex: int + 'Not available') vão como texto."""
+    import pyarrow as pa
+    mixed = {}
+    for c in df.columns[df.dtypes == object]:
+        try: pa.array(df[c])
+        except (pa.ArrowInvalid, pa.ArrowTypeError): mixed[c] = df[c].astype(str)
+    return pa.Table.from_pandas(df.assign(**mixed) if mixed else df, preserve_index=preserve_index)
+
+
+def _matplotlib_figure(obj):
+    # Figure, Axes ou grids do seaborn (FacetGrid/PairGrid/JointGrid)
+    if hasattr(obj, "canvas") and hasattr(obj, "savefig"): return obj
+    fig = getattr(obj, "figure", None)
+    return fig if hasattr(fig, "savefig") and hasattr(fig, "canvas") else None
+
+
+# Execução no próprio processo: redirect_stdout e o registro de figuras do pyplot são do
+# processo inteiro, então uma célula por vez entre todas as sessões/orquestradores
+_EXEC_LOCK = threading.Lock()
+
+
+def _open_figures():
+    # Só consulta o pyplot se a célula (ou alguém) já o importou
+    plt = sys.modules.get("matplotlib.pyplot")
+    return set(plt.get_fignums()) if plt else set()
+
+
+def _new_figures(before, close=False):
+    plt = sys.modules.get("matplotlib.pyplot")
+    if plt is None: return []
+    figs = [plt.figure(n) for n in sorted(set(plt.get_fignums()) - before)]
+    if close:
+        for f in figs: plt.close(f)
+    return figs
+
+
+def render_output(obj, max_rows=10_000):
+    """
+    Converte um resultado de célula (tabela, figura ou valor) em um item compacto para a
+    interface, uma única vez: tabelas viram pa.Table com no máximo `max_rows` linhas
+    (paginadas na tela), figuras matplotlib viram PNG e são fechadas, plotly vira JSON.
+    Retorna dict com "kind": table | image | plotly | json | text.
+    """
+    try:
+        if isinstance(obj, LazyDataset):
+            return {"kind": "table", "table": arrow_table(obj.head(max_rows)), "total_rows": len(obj)}
+        if isinstance(obj, pd.Series): obj = obj.to_frame()
+        if isinstance(obj, pd.DataFrame):
+            return {"kind": "table", "table": arrow_table(obj.head(max_rows)), "total_rows": len(obj)}
+        if hasattr(obj, "to_plotly_json"):
+            return {"kind": "plotly", "json": obj.to_json()}
+        fig = _matplotlib_figure(obj)
+        if fig is not None:
+            buf = io.BytesIO()
+            fig.savefig(buf, format="png", bbox_inches="tight")
+            if "matplotlib.pyplot" in sys.modules: sys.modules["matplotlib.pyplot"].close(fig)
+            return {"kind": "image", "format": "png", "data": buf.getvalue()}
+        if isinstance(obj, (dict, list)):
+            json.dumps(obj)
+            return {"kind": "json", "value": obj}
+    except Exception as e:
+        logger.warning(f"Falha ao converter resultado para exibição: {e}")
+    text = obj if isinstance(obj, str) else repr(obj)
+    return {"kind": "text", "text": text[:20_000]}
+
+
+def _strata_column(df, max_strata=50, probe_rows=50_000, seed=0):
+    # Coluna categórica de menor cardinalidade (>= 2 classes): em geral o alvo ou um grupo.
+    # Linhas sorteadas (não o head: extratos ordenados escondem classes raras no fim) fazem a
+    # pré-seleção; a cardinalidade das candidatas é conferida na coluna inteira. Empate em
+    # cardinalidade: vence a coluna com a classe mais rara (é ela que some numa amostra uniforme)
+    if len(df) > probe_rows:
+        probe = df.iloc[np.sort(np.random.default_rng(seed).choice(len(df), probe_rows, replace=False))]
+    else:
+        probe = df
+    best, best_rank = None, None
+    for col in df.columns:
+        s = probe[col]
+        if not (s.dtype == object or isinstance(s.dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(s)
+                or pd.api.types.is_string_dtype(s) or pd.api.types.is_integer_dtype(s)):
+            continue
+        try:
+            if s.nunique(dropna=False) > max_strata: continue
+            counts = df[col].value_counts(dropna=False)
+        except TypeError: continue  # listas/dicts não são hasheáveis
+        rank = (len(counts), int(counts.min()) if len(counts) else 0)
+        if 2 <= rank[0] <= max_strata and (best_rank is None or rank < best_rank): best, best_rank = col, rank
+    return best
+
+
+def sample_frame(df, n_rows, strategy="stratified", stratify_by=None, min_per_stratum=5, seed=0):
+    """
+    Amostra de df para a prévia de uma célula. `head` pega as primeiras linhas;
+    `stratified` sorteia dentro de cada classe de `stratify_by` (ou da coluna categórica de
+    menor cardinalidade), com pelo menos `min_per_stratum` linhas por classe para que
+    groupby, CV estratificado e gráficos por classe não quebrem só na amostra.
+    Mantém a ordem original das linhas.
+    """
+    if len(df) <= n_rows: return df
+    if strategy == "head": return df.head(n_rows)
+    rng = np.random.default_rng(seed)
+    col = stratify_by or _strata_column(df, seed=seed)
+    if col is None:
+        return df.iloc[np.sort(rng.choice(len(df), n_rows, replace=False))]
+    codes, _ = pd.factorize(df[col], use_na_sentinel=False)
+    frac = n_rows / len(df)
+    order = np.argsort(codes, kind="stable")
+    groups = np.split(order, np.cumsum(np.bincount(codes))[:-1])
+    picks = [rng.choice(g, min(len(g), max(min_per_stratum, round(len(g) * frac))), replace=False) for g in groups]
+    return df.iloc[np.sort(np.concatenate(picks))]
+
+
+_STOPWORDS = {
+    "a", "o", "as", "os", "de", "da", "do", "das", "dos", "e", "em", "no", "na", "nos", "nas",
+    "um", "uma", "uns", "umas", "para", "por", "com", "sem", "ao", "aos", "que", "se", "the",
+    "of", "and", "to", "in", "for", "on", "by", "with", "from", "is", "ou", "or", "como",
+    "pelo", "pela", "cada", "entre", "sobre", "seu", "sua", "seus", "suas", "este", "esta",
+}
+
+
+def _tokenize(text):
+    # minúsculas, sem acentos, snake_case quebrado; radical grosseiro (6 letras)
+    # aproxima termos em PT e EN ("histograma" ~ "histogram", "distribuições" ~ "distribution")
+    text = unicodedata.normalize("NFKD", str(text or "")).encode("ascii", "ignore").decode().lower()
+    tokens = [t for t in re.split(r"[^a-z0-9]+", text) if len(t) > 1 and t not in _STOPWORDS]
+    return [(t[:-1] if len(t) > 3 and t.endswith("s") else t)[:6] for t in tokens]
+
+
+class KBIndex:
+    """Índice BM25 local sobre titulo/descricao/categoria/subcategoria da KB."""
+    FIELDS = {"titulo": 3, "descricao": 2, "categoria": 1, "subcategoria": 1}
+
+    def __init__(self, knowledge_base, k1=1.5, b=0.75):
+        self.k1, self.b = k1, b
+        self.titles = []
+        self.doc_tfs = []
+        self.doc_lens = []
+        df_counts = {}
+        for func in knowledge_base:
+            tokens = []
+            for field, weight in self.FIELDS.items():
+                tokens += _tokenize(func.get(field, "")) * weight
+            tf = {}
+            for t in tokens: tf[t] = tf.get(t, 0) + 1
+            for t in tf: df_counts[t] = df_counts.get(t, 0) + 1
+            self.titles.append(func.get("titulo"))
+            self.doc_tfs.append(tf)
+            self.doc_lens.append(len(tokens))
+        n = len(self.titles)
+        self.avg_len = (sum(self.doc_lens) / n) if n else 0.0
+        self.idf = {t: math.log(1 + (n - c + 0.5) / (c + 0.5)) for t, c in df_counts.items()}
+
+    @classmethod
+    def load_or_build(cls, knowledge_base, kb_path, cache_dir):
+        """Reaproveita o índice persistido enquanto o arquivo da KB não mudar."""
+        try:
+            st_kb = os.stat(kb_path)
+            sig = hashlib.sha1(f"{os.path.abspath(kb_path)}:{st_kb.st_mtime_ns}:{st_kb.st_size}".encode()).hexdigest()[:16]
+        except OSError:
+            return cls(knowledge_base)
+        path = os.path.join(cache_dir, f"kb_index_{sig}.pkl")
+        if os.path.exists(path):
+            try:
+                with open(path, "rb") as f: return pickle.load(f)
+            except Exception as e: logger.warning(f"Índice da KB inválido, reconstruindo: {e}")
+        index = cls(knowledge_base)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(path, "wb") as f: pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e: logger.warning(f"Não foi possível persistir índice da KB: {e}")
+        return index
+
+    def search(self, query, top_k=8):
+        q_tokens = set(_tokenize(query))
+        scores = []
+        for i, tf in enumerate(self.doc_tfs):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lens[i] / (self.avg_len or 1))
+            for t in q_tokens:
+                f = tf.get(t)
+                if f: score += self.idf[t] * f * (self.k1 + 1) / (f + norm)
+            if score > 0: scores.append((self.titles[i], score))
+        scores.sort(key=lambda x: x[1], reverse=True)
+        return scores[:top_k]
+
+
+def _is_literal(node):
+    try:
+        ast.literal_eval(node)
+        return True
+    except Exception:
+        return False
+
+
+# Reduções: frame -> series, series -> escalar
+_REDUCTIONS = {"mean", "sum", "median", "min", "max", "std", "var", "sem", "prod", "count", "nunique",
+               "skew", "kurt", "quantile", "idxmin", "idxmax", "any", "all"}
+# Métodos que não devolvem frame/series (texto, estruturas Python, None)
+_NON_FRAME_METHODS = {"info", "to_string", "to_dict", "to_json", "to_csv", "to_markdown", "to_html", "to_list",
+                      "tolist", "to_numpy", "unique", "item", "items", "iterrows", "itertuples", "keys", "equals"}
+
+
+def _pandas_kind(node):
+    """
+    Inferência estática e conservadora do que uma expressão sobre `df` devolve:
+    "frame", "series", "groupby" ou None (escalar, atributo ou desconhecido).
+    """
+    if isinstance(node, ast.Name):
+        return "frame" if node.id == "df" else None
+    if isinstance(node, ast.Attribute):
+        base = _pandas_kind(node.value)
+        if base == "frame" and node.attr in ("T", "loc", "iloc"): return "frame" if node.attr == "T" else "indexer"
+        if base == "series" and node.attr in ("loc", "iloc"): return "indexer"
+        return None
+    if isinstance(node, ast.Subscript):
+        base = _pandas_kind(node.value)
+        key = node.slice
+        if base == "groupby": return "groupby"
+        if base == "indexer":
+            # df.loc[0, "a"] / df.iloc[0, 1] é uma célula; com fatias ou listas continua sendo frame/series
+            elts = key.elts if isinstance(key, ast.Tuple) else [key]
+            return None if all(isinstance(e, ast.Constant) for e in elts) and len(elts) > 1 else "frame"
+        if base == "frame": return "series" if isinstance(key, ast.Constant) else "frame"
+        if base == "series": return None if isinstance(key, ast.Constant) else "series"
+        return None
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+        base, method = _pandas_kind(node.func.value), node.func.attr
+        if base is None or base == "indexer" or method in _NON_FRAME_METHODS: return None
+        if base == "groupby": return "frame"
+        if method == "groupby": return "groupby"
+        if base == "series" and method in _REDUCTIONS | {"corr", "cov"}: return None
+        if base == "frame" and method in _REDUCTIONS: return "series"
+        return base
+    return None
+
+
+class CodeJudge(ast.NodeTransformer):
+    """
+    Judge local e determinístico para o código gerado:
+    - esvazia `data = {...}` e `x = pd.DataFrame({...})` montados só com literais (mock),
+      mantendo o nome definido (`data = {}`, `x = pd.DataFrame()`);
+    - troca `print(<frame ou series de df>)` por `display(...)`;
+    - rejeita código que reatribui `df` a partir de literais.
+    Se um mock esvaziado é lido depois, o judge local não decide: vai para o judge LLM.
+    As alterações são aplicadas por posição no texto original, preservando comentários.
+    """
+    def __init__(self):
+        self.edits = []
+        self.issues = []
+        self.rejected = False
+        self.mock_names = set()
+        self.mock_reads = set()
+
+    def _is_mock_frame(self, node):
+        # pd.DataFrame({...}) / pd.DataFrame(data=[...]) só com literais, ou a partir de um mock já removido
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "DataFrame"):
+            return False
+        data = [k.value for k in node.keywords if k.arg == "data"]
+        arg = node.args[0] if node.args else (data[0] if data else None)
+        if arg is None: return False
+        if isinstance(arg, ast.Name): return arg.id in self.mock_names
+        return isinstance(arg, (ast.Dict, ast.List)) and _is_literal(arg)
+
+    def _bindings(self, target, value):
+        # Pares (nome, valor); `a, b = x, y` é desempacotado elemento a elemento
+        if isinstance(target, ast.Name): return [(target.id, value)]
+        if (isinstance(target, (ast.Tuple, ast.List)) and isinstance(value, (ast.Tuple, ast.List))
+                and len(target.elts) == len(value.elts)):
+            return [p for t, v in zip(target.elts, value.elts) for p in self._bindings(t, v)]
+        return []
+
+    def _judge_assign(self, node, targets):
+        bindings = [p for t in targets for p in self._bindings(t, node.value)]
+        mocked = []
+        for name, value in bindings:
+            is_mock_frame = self._is_mock_frame(value)
+            if name == "df" and (is_mock_frame or (isinstance(value, (ast.Dict, ast.List)) and _is_literal(value))):
+                self.rejected = True
+                self.issues.append(f"Linha {node.lineno}: `df` reatribuído a partir de literais (dados mock).")
+                return node
+            if is_mock_frame or (name == "data" and isinstance(value, ast.Dict) and _is_literal(value)):
+                self.mock_names.add(name)
+                if any(v is value for v in mocked): continue  # `a = b = {...}`: uma edição só
+                mocked.append(value)
+                self.issues.append(f"Linha {node.lineno}: mock removido.")
+                # Só o valor muda: o nome segue definido e o resto da linha (`; ...`) é preservado
+                empty = f"{ast.unparse(value.func)}()" if is_mock_frame else "{}"
+                self.edits.append((value.lineno, value.col_offset, value.end_lineno, value.end_col_offset, empty))
+        if not mocked: return self.generic_visit(node)
+        # Os valores mock não contam como leitura; o restante da atribuição é visitado normalmente
+        values = node.value.elts if isinstance(node.value, (ast.Tuple, ast.List)) else [node.value]
+        for value in values:
+            if not any(v is value for v in mocked): self.visit(value)
+        return node
+
+    def visit_Assign(self, node):
+        return self._judge_assign(node, node.targets)
+
+    def visit_AnnAssign(self, node):
+        # `df: pd.DataFrame = pd.DataFrame({...})`
+        if node.value is None: return node
+        return self._judge_assign(node, [node.target])
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load) and node.id in self.mock_names and node.id not in self.mock_reads:
+            self.mock_reads.add(node.id)
+            self.issues.append(f"Linha {node.lineno}: `{node.id}` (mock removido) é usado depois.")
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        # Só frames/series viram display; print(df.shape[0]) ou print(df['a'].mean()) continuam como texto
+        if (isinstance(node.func, ast.Name) and node.func.id == "print" and len(node.args) == 1
+                and not node.keywords and _pandas_kind(node.args[0]) in ("frame", "series")):
+            f = node.func
+            self.edits.append((f.lineno, f.col_offset, f.end_lineno, f.end_col_offset, "display"))
+            self.issues.append(f"Linha {node.lineno}: print(df) trocado por display(df).")
+            node.func = ast.copy_location(ast.Name(id="display", ctx=ast.Load()), f)
+        return node
+
+
+def judge_code(code_str):
+    """
+    Aplica o CodeJudge. Retorna dict com code, status ('ok' | 'rejected' | 'syntax_error'),
+    issues e needs_llm (True quando o judge local não consegue decidir/corrigir sozinho).
+    """
+    try:
+        tree = ast.parse(code_str)
+    except SyntaxError as e:
+        return {"code": code_str, "status": "syntax_error", "needs_llm": True,
+                "issues": [f"Erro de sintaxe na linha {e.lineno}, coluna {e.offset}: {e.msg}"]}
+
+    judge = CodeJudge()
+    judge.visit(tree)
+    if judge.rejected:
+        return {"code": code_str, "status": "rejected", "needs_llm": True, "issues": judge.issues}
+
+    # Aplica as edições de trás para frente para não deslocar as posições anteriores
+    lines = code_str.splitlines(keepends=True)
+    offsets = [0]
+    for line in lines: offsets.append(offsets[-1] + len(line))
+
+    def pos(lineno, col):
+        # col_offset do ast é em bytes UTF-8
+        line = lines[lineno - 1]
+        return offsets[lineno - 1] + len(line.encode("utf-8")[:col].decode("utf-8", "ignore"))
+
+    new_code = code_str
+    for start_l, start_c, end_l, end_c, text in sorted(judge.edits, reverse=True):
+        new_code = new_code[:pos(start_l, start_c)] + text + new_code[pos(end_l, end_c):]
+    # Mock esvaziado e lido depois: o código rodaria sobre dados vazios; o judge LLM reescreve
+    return {"code": new_code, "status": "ok", "needs_llm": bool(judge.mock_reads), "issues": judge.issues}
+
+
+class _LazyModule:
+    """Proxy que só importa o módulo no primeiro acesso a um atributo."""
+    def __init__(self, module_name, import_times):
+        self._module_name = module_name
+        self._module = None
+        self._import_times = import_times
+
+    def _load(self):
+        if self._module is None:
+            t0 = time.perf_counter()
+            self._module = importlib.import_module(self._module_name)
+            self._import_times[self._module_name] = time.perf_counter() - t0
+        return self._module
+
+    def __getattr__(self, name):
+        if name.startswith("_module") or name == "_import_times": raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        return f"<lazy module '{self._module_name}'>"
+
+
+# Símbolos usados (sem import) pelas funções da KB: nome -> "modulo" ou "modulo:atributo".
+# Só os globals das funções da KB os resolvem; nas células um nome desconhecido continua
+# sendo NameError (o loop de correção precisa ver o erro).
+_KB_SYMBOLS = {
+    "pd": "pandas", "np": "numpy", "plt": "matplotlib.pyplot", "sns": "seaborn",
+    "px": "plotly.express", "go": "plotly.graph_objects", "nx": "networkx", "shap": "shap",
+    "stats": "scipy.stats", "patches": "matplotlib.patches",
+    "Path": "pathlib:Path", "Axes": "matplotlib.axes:Axes", "PercentFormatter": "matplotlib.ticker:PercentFormatter",
+    **{n: f"typing:{n}" for n in ("Any", "Callable", "Dict", "List", "Literal", "Optional", "Set", "Tuple", "Union")},
+    **{n: f"scipy.stats:{n}" for n in ("norm", "binom", "poisson", "shapiro", "linregress", "t")},
+    **{n: f"scipy.spatial.distance:{n}" for n in ("pdist", "squareform")},
+    **{n: f"scipy.cluster.hierarchy:{n}" for n in ("dendrogram", "linkage", "cut_tree")},
+    **{n: f"sklearn.base:{n}" for n in ("BaseEstimator", "clone", "is_classifier")},
+    **{n: f"sklearn.model_selection:{n}" for n in (
+        "StratifiedKFold", "KFold", "GridSearchCV", "RandomizedSearchCV", "train_test_split", "cross_val_score")},
+    **{n: f"sklearn.metrics:{n}" for n in (
+        "auc", "accuracy_score", "precision_score", "recall_score", "f1_score", "matthews_corrcoef",
+        "classification_report", "confusion_matrix", "roc_auc_score", "precision_recall_curve", "roc_curve")},
+    **{n: f"sklearn.preprocessing:{n}" for n in ("StandardScaler", "MinMaxScaler", "OrdinalEncoder", "KBinsDiscretizer")},
+    **{n: f"sklearn.impute:{n}" for n in ("SimpleImputer", "KNNImputer", "IterativeImputer")},
+    "PCA": "sklearn.decomposition:PCA", "KMeans": "sklearn.cluster:KMeans",
+    "NotFittedError": "sklearn.exceptions:NotFittedError", "CalibratedClassifierCV": "sklearn.calibration:CalibratedClassifierCV",
+    "SelectPercentile": "sklearn.feature_selection:SelectPercentile", "f_classif": "sklearn.feature_selection:f_classif",
+    "BayesianRidge": "sklearn.linear_model:BayesianRidge", "LinearRegression": "sklearn.linear_model:LinearRegression",
+}
+
+
+def _resolve_symbol(name):
+    target = _KB_SYMBOLS[name]
+    module_name, _, attr = target.partition(":")
+    if attr == "IterativeImputer":
+        importlib.import_module("sklearn.experimental.enable_iterative_imputer")
+    module = importlib.import_module(module_name)
+    return getattr(module, attr) if attr else module
+
+
+class _LazyGlobals(dict):
+    """
+    Globals com resolução sob demanda (__missing__): funções da KB (e, com `kb_symbols`,
+    os símbolos de _KB_SYMBOLS) são importadas/compiladas só quando o código as referencia.
+    Nomes de builtins são copiados para o dict no primeiro uso para não repetir o __missing__.
+    """
+    def __init__(self, *args, kb_library=None, kb_symbols=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._kb_library = kb_library
+        self._kb_symbols = kb_symbols
+
+    def __missing__(self, name):
+        if self._kb_symbols and name in _KB_SYMBOLS:
+            value = _resolve_symbol(name)
+        elif self._kb_library is not None and self._kb_library.has(name):
+            value = self._kb_library.get(name)
+        elif hasattr(builtins, name):
+            value = getattr(builtins, name)
+        else:
+            raise KeyError(name)
+        self[name] = value
+        return value
+
+
+class KBLibrary:
+    """
+    Funções da KB compiladas uma vez e expostas como módulo importável `tcd_kb`
+    (`from tcd_kb import plot_histogram`) e no namespace das células.
+    Cada função só é compilada no primeiro uso; o arquivo é relido quando o mtime muda.
+    """
+    MODULE_NAME = "tcd_kb"
+
+    def __init__(self, kb_path):
+        self.kb_path = kb_path
+        self._mtime = None
+        self._lock = threading.Lock()
+        self.sources = {}
+        self.globals = None
+        self.module = None
+        self.refresh()
+
+    def refresh(self):
+        try: mtime = os.stat(self.kb_path).st_mtime_ns
+        except OSError: mtime = None
+        if mtime == self._mtime and self.module is not None: return
+        with self._lock:
+            if mtime != self._mtime or self.module is None: self._reload(mtime)
+
+    def _reload(self, mtime):
+        sources = {}
+        if mtime is not None:
+            with open(self.kb_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        func = json.loads(line)
+                        sources[func["titulo"]] = func["codigo_funcao"]
+                    except Exception: pass
+        self._mtime = mtime
+        self.sources = sources
+        self.globals = _LazyGlobals({"__name__": self.MODULE_NAME, "__builtins__": builtins}, kb_library=self, kb_symbols=True)
+        module = types.ModuleType(self.MODULE_NAME, "Funções da Base de Conhecimento (carregadas sob demanda).")
+        module.__getattr__ = self._module_getattr
+        module.__all__ = list(self.sources)
+        self.module = module
+        sys.modules[self.MODULE_NAME] = module
+        logger.info(f"KB compilável carregada: {len(self.sources)} funções")
+
+    def has(self, name):
+        return name in self.sources
+
+    def get(self, name):
+        if name in self.globals: return self.globals[name]
+        # annotations adiadas: tipos como BaseEstimator não precisam existir na definição
+        code_obj = compile(self.sources[name], f"<kb:{name}>", "exec",
+                           flags=__future__.annotations.compiler_flag, dont_inherit=True)
+        exec(code_obj, self.globals)
+        return dict.__getitem__(self.globals, name)
+
+    def _module_getattr(self, name):
+        if name in self.sources: return self.get(name)
+        raise AttributeError(f"module '{self.MODULE_NAME}' has no attribute '{name}'")
+
+
+class ExecutionNamespace:
+    """
+    Namespace base persistente para as células: pd/np/plt/sns/px/go resolvidos sob
+    demanda e cache de objetos de código compilados (chave = hash do código).
+    """
+    LAZY_MODULES = {
+        "np": "numpy",
+        "plt": "matplotlib.pyplot",
+        "sns": "seaborn",
+        "px": "plotly.express",
+        "go": "plotly.graph_objects",
+        "pa": "pyarrow",
+        "pc": "pyarrow.compute",
+        "ds": "pyarrow.dataset",
+    }
+
+    def __init__(self, max_compiled=256, kb_library=None):
+        t0 = time.perf_counter()
+        self.kb_library = kb_library
+        self.import_times = {}
+        self.base = {"pd": pd, "__builtins__": __builtins__}
+        for alias, module_name in self.LAZY_MODULES.items():
+            self.base[alias] = _LazyModule(module_name, self.import_times)
+        self.max_compiled = max_compiled
+        self._compiled = OrderedDict()
+        self.cold_start_s = time.perf_counter() - t0
+
+    def compile(self, code_str):
+        key = hashlib.sha256(code_str.encode("utf-8")).hexdigest()
+        if key in self._compiled:
+            self._compiled.move_to_end(key)
+            return self._compiled[key], True
+        code_obj = compile(code_str, "<celula>", "exec")
+        self._compiled[key] = code_obj
+        if len(self._compiled) > self.max_compiled: self._compiled.popitem(last=False)
+        return code_obj, False
+
+    def new_globals(self, display):
+        # Cópia rasa: cada execução começa limpa, mas reaproveita os proxies já carregados
+        exec_globals = _LazyGlobals(self.base, kb_library=self.kb_library)
+        exec_globals["display"] = display
+        return exec_globals
+
+
+class DatasetLease:
+    """Referência de uma sessão a um frame do SharedStore; liberada ao ser coletada."""
+    def __init__(self, store, key):
+        self.key = key
+        self._finalizer = weakref.finalize(self, store.release_frame, key)
+
+    def release(self):
+        self._finalizer()
+
+
+# Nome de import -> distribuição no PyPI, quando diferem
+IMPORT_TO_DIST = {
+    "sklearn": "scikit-learn", "skimage": "scikit-image", "cv2": "opencv-python", "PIL": "Pillow",
+    "yaml": "PyYAML", "bs4": "beautifulsoup4", "dateutil": "python-dateutil", "dotenv": "python-dotenv",
+    "Crypto": "pycryptodome", "attr": "attrs", "docx": "python-docx", "pptx": "python-pptx",
+    "fitz": "PyMuPDF", "umap": "umap-learn", "Levenshtein": "python-Levenshtein",
+    "mpl_toolkits": "matplotlib", "python_calamine": "python-calamine", "streamlit_ace": "streamlit-ace",
+}
+
+
+class InstallJob:
+    """pip install rodando em thread; `logs` recebe a saída linha a linha."""
+    def __init__(self, dists):
+        self.dists = dists
+        self.logs = []
+        self.status = "running"  # running | done | failed
+        self.returncode = None
+        self.done = threading.Event()
+
+    @property
+    def ok(self):
+        return self.status == "done"
+
+
+class DependencyResolver:
+    """
+    Resolve os imports do código gerado com cache por processo: stdlib e módulos locais
+    nunca chegam ao find_spec, e o resultado de cada módulo só é descartado depois de uma
+    instalação. Instalações rodam em background (wheelhouse local e/ou índice configurado)
+    e são compartilhadas entre as sessões que pedem as mesmas distribuições.
+    """
+    LOCAL_MODULES = {KBLibrary.MODULE_NAME, "src"}
+
+    def __init__(self, wheelhouse=None, index_url=None, offline=False):
+        self.wheelhouse = wheelhouse
+        self.index_url = index_url
+        self.offline = offline
+        self.known = set(sys.stdlib_module_names) | set(sys.builtin_module_names) | self.LOCAL_MODULES
+        self._available = {}
+        self._imports = OrderedDict()  # hash do código -> imports (o parse domina o custo)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def imports_of(self, code_str, max_entries=1024):
+        """Módulos de topo importados pelo código. Levanta SyntaxError."""
+        key = hashlib.sha1(code_str.encode("utf-8")).hexdigest()
+        with self._lock:
+            hit = self._imports.get(key)
+        if hit is not None: return hit
+        imports = set()
+        for node in ast.walk(ast.parse(code_str)):
+            if isinstance(node, ast.Import):
+                for n in node.names: imports.add(n.name.split('.')[0])
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                imports.add(node.module.split('.')[0])
+        imports = frozenset(imports)
+        with self._lock:
+            self._imports[key] = imports
+            if len(self._imports) > max_entries: self._imports.popitem(last=False)
+        return imports
+
+    def is_available(self, module):
+        if module in self.known: return True
+        with self._lock:
+            hit = self._available.get(module)
+        if hit is not None: return hit
+        try: ok = importlib.util.find_spec(module) is not None
+        except (ImportError, ValueError): ok = False
+        with self._lock: self._available[module] = ok
+        return ok
+
+    def missing(self, code_str):
+        return sorted(m for m in self.imports_of(code_str) if not self.is_available(m))
+
+    @staticmethod
+    def distributions(modules):
+        # "sklearn.experimental" (de um MissingDependency) -> pacote de topo "sklearn" -> "scikit-learn"
+        tops = {m.split(".")[0] for m in modules}
+        return sorted({IMPORT_TO_DIST.get(m, m) for m in tops})
+
+    def prewarm(self, codes):
+        """Resolve de uma vez os imports de vários códigos (ex: funções da KB). Retorna os módulos importados."""
+        modules = set()
+        for code in codes:
+            try: modules |= self.imports_of(code)
+            except SyntaxError: continue
+        for m in modules: self.is_available(m)
+        return modules
+
+    def invalidate(self):
+        with self._lock: self._available.clear()
+        importlib.invalidate_caches()
+
+    def pip_command(self, dists):
+        cmd = [sys.executable, "-m", "pip", "install", "--disable-pip-version-check", "--progress-bar", "off"]
+        if self.wheelhouse: cmd += ["--find-links", self.wheelhouse]
+        if self.offline: cmd += ["--no-index"]
+        elif self.index_url: cmd += ["--index-url", self.index_url]
+        return cmd + list(dists)
+
+    def install(self, modules):
+        """Dispara (ou reaproveita, se já estiver rodando) a instalação em background. Retorna o InstallJob."""
+        dists = tuple(self.distributions(modules))
+        with self._lock:
+            job = self._jobs.get(dists)
+            if job is not None and job.status == "running": return job
+            job = self._jobs[dists] = InstallJob(dists)
+        threading.Thread(target=self._run_install, args=(job,), daemon=True, name="tcd-pip").start()
+        return job
+
+    def _run_install(self, job):
+        cmd = self.pip_command(job.dists)
+        job.logs.append(f"$ pip install {' '.join(job.dists)}")
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            for line in proc.stdout:
+                line = line.rstrip()
+                if line: job.logs.append(line)
+            job.returncode = proc.wait()
+        except Exception as e:
+            job.logs.append(str(e))
+            job.returncode = -1
+        # Instalação concluída: só agora o cache de resolução fica velho
+        if job.returncode == 0: self.invalidate()
+        job.status = "done" if job.returncode == 0 else "failed"
+        logger.info(f"pip install {job.dists}: {job.status}")
+        job.done.set()
+
+
+class BackgroundRun:
+    """execute_cached rodando em thread; `result` fica disponível quando `done` é setado."""
+    def __init__(self, code_str, task_id=None):
+        self.code = code_str
+        self.task_id = task_id
+        self.result = None
+        self.started = time.perf_counter()
+        self.finished = None
+        self.done = threading.Event()
+
+    @property
+    def elapsed_s(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+
+class SharedStore:
+    """
+    Armazenamento por processo, compartilhado entre as sessões do Streamlit:
+    - recursos da KB (lista parseada, índice, biblioteca) carregados uma vez por versão do arquivo;
+    - datasets enviados, deduplicados pelo hash do conteúdo e contados por referência.
+    Os frames são compartilhados somente leitura: com copy-on-write, a sessão que altera
+    o df ganha sua própria cópia das colunas alteradas. Frames sem referências ficam como
+    cache até o total passar de `max_memory_mb`, quando os menos usados são descartados.
+    """
+    def __init__(self, max_memory_mb=2048):
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024
+        self._lock = threading.RLock()
+        self._resources = {}
+        self._frames = OrderedDict()
+        self._loading = {}
+
+    def resource(self, key, factory):
+        with self._lock:
+            if key not in self._resources: self._resources[key] = factory()
+            return self._resources[key]
+
+    def kb_resource(self, kb_path, kind, factory):
+        try: mtime = os.stat(kb_path).st_mtime_ns
+        except OSError: mtime = None
+        return self.resource((os.path.abspath(kb_path), mtime, kind), factory)
+
+    def acquire_frame(self, key, loader):
+        """Retorna (df, lease). `loader` só roda se nenhuma sessão já tiver carregado `key`."""
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        # Lock por chave: duas sessões enviando o mesmo arquivo carregam uma vez só
+        with key_lock:
+            with self._lock:
+                entry = self._frames.get(key)
+            if entry is None:
+                df = loader()
+                entry = {"df": df, "refs": 0, "nbytes": int(df.memory_usage(deep=False).sum())}
+                with self._lock: self._frames[key] = entry
+            else:
+                logger.info(f"Dataset compartilhado: {key[:12]} ({entry['refs']} sessões)")
+        with self._lock:
+            entry["refs"] += 1
+            self._frames.move_to_end(key)
+            self._evict()
+        return entry["df"], DatasetLease(self, key)
+
+    def release_frame(self, key):
+        with self._lock:
+            entry = self._frames.get(key)
+            if entry is None: return
+            entry["refs"] = max(entry["refs"] - 1, 0)
+            self._evict()
+
+    def memory_usage(self):
+        with self._lock: return sum(e["nbytes"] for e in self._frames.values())
+
+    def _evict(self):
+        for key in list(self._frames):
+            if self.memory_usage() <= self.max_memory_bytes: break
+            if self._frames[key]["refs"] == 0:
+                del self._frames[key]
+                self._loading.pop(key, None)
+
+
+SHARED_STORE = SharedStore(max_memory_mb=int(os.getenv("TCD_SHARED_MEMORY_MB", "2048")))
+SHARED_RESOLVER = DependencyResolver(
+    wheelhouse=os.getenv("TCD_WHEELHOUSE") or None,
+    index_url=os.getenv("TCD_PIP_INDEX_URL") or None,
+    offline=os.getenv("TCD_PIP_OFFLINE", "0") == "1",
+)
+
+
 class BackendOrchestrator:
-    def __init__(self, kb_path="data/kb.jsonl"):
+    def __init__(self, kb_path="data/kb.jsonl", cache_dir=".cache", store=None, deps=None):
         self.kb_path = kb_path
-        self.knowledge_base = self.load_knowledge_base()
+        self.cache_dir = cache_dir
+        self.store = store or SHARED_STORE
+        self.deps = deps or SHARED_RESOLVER
+        self.knowledge_base = self.store.kb_resource(kb_path, "kb", self.load_knowledge_base)
+        self.kb_index = self.store.kb_resource(
+            kb_path, "index", lambda: KBIndex.load_or_build(self.knowledge_base, self.kb_path, self.cache_dir)
+        )
+        self.kb_library = self.store.kb_resource(kb_path, "library", lambda: KBLibrary(self.kb_path))
+        # Imports das funções da KB resolvidos uma vez por versão do arquivo
+        self.kb_imports = self.store.kb_resource(
+            kb_path, "deps", lambda: self.deps.prewarm(f.get("codigo_funcao", "") for f in self.knowledge_base)
+        )
+        self.profiler = DatasetProfiler()
+        # ExecutionPool opcional (src/worker_pool.py); None = execução no próprio processo
+        self.pool = None
+        self.namespace = None
+        # last_run_stats é por thread: a execução completa em background não sobrescreve a da prévia
+        self._local = threading.local()
+        # Perfil por célula (opt-in): grava last_run_stats["profile"]; profile_top_n > 0 liga o cProfile
+        self.profiling = False
+        self.profile_top_n = 0
+        # Limite de linhas por tabela convertida para exibição (execute_cached com render)
+        self.render_max_rows = 10_000
+        # Raiz permitida para load_lazy_dataset(path=...); None = leitura por caminho desativada
+        self.data_root = None
+        # Prévia: frames pandas acima de preview_rows linhas rodam antes numa amostra (0 = desligado)
+        self.preview_rows = 0
+        self.preview_strategy = "stratified"
+        # Teto do cache de ingestão em disco (cache_dir/ingest); os menos usados saem primeiro
+        self.ingest_cache_mb = 2048
+
+    @property
+    def last_run_stats(self):
+        return getattr(self._local, "stats", {})
+
+    @last_run_stats.setter
+    def last_run_stats(self, stats):
+        self._local.stats = stats
 
     def load_knowledge_base(self):
         kb = []
@@ -29,6 +1250,74 @@ class BackendOrchestrator:
     def get_kb_metadata(self):
         return [{"titulo": f.get("titulo"), "descricao": f.get("descricao")} for f in self.knowledge_base]
         
+    def select_kb_candidates(self, step_description, top_k=8, min_score=6.0, margin=1.5):
+        """
+        Pré-seleção local (BM25) de funções da KB para um passo.
+        Retorna (candidatos, escolhidas): `candidatos` é a lista curta de metadados para o
+        LLM reordenar; `escolhidas` só vem preenchida quando o índice tem confiança alta
+        (score mínimo e folga sobre o segundo colocado), dispensando a chamada ao LLM.
+        """
+        ranked = self.kb_index.search(step_description, top_k)
+        by_title = {f.get("titulo"): f for f in self.knowledge_base}
+        candidates = [{"titulo": t, "descricao": by_title[t].get("descricao")} for t, _ in ranked]
+        chosen = []
+        if ranked and ranked[0][1] >= min_score and (len(ranked) == 1 or ranked[0][1] >= margin * ranked[1][1]):
+            chosen = [ranked[0][0]]
+        return candidates, chosen
+
+    def generate_code_for_step(self, gemini, step_description, user_objective, df_metadata, log=None, on_code=None, engine="pandas"):
+        """
+        Pipeline de geração de uma célula: seleciona KB → escreve → julga → checa deps.
+        Não usa Streamlit, então pode rodar em threads. `on_code` recebe o código parcial
+        durante o streaming; `engine` ("pandas" ou "arrow") vai para o prompt.
+        Retorna (codigo, libs_faltando); codigo vazio quando o judge rejeita o resultado.
+        """
+        log = log or (lambda msg: None)
+
+        def log_latency():
+            m = gemini.last_metrics()
+            if m: log(f"⏱️ {m['stage']}: ~{m['prompt_tokens']} tokens | TTFT {m['ttft_s']:.2f}s | total {m['total_s']:.2f}s" + (" (cache)" if m['cached'] else ""))
+
+        log("🔍 Selecionando KB...")
+        candidates, funcs = self.select_kb_candidates(step_description)
+        if funcs:
+            log("⚡ KB: seleção local (índice BM25)")
+        elif candidates:
+            # LLM só reordena a lista curta do índice local
+            funcs = gemini.select_relevant_functions(step_description, candidates)
+            log_latency()
+        full_code = self.get_specific_functions_code(funcs)
+        if funcs: log(f"📚 Funções: {', '.join(funcs)}")
+
+        log("✍️ Escrevendo código...")
+        draft = gemini.generate_final_code(step_description, user_objective, df_metadata, full_code, on_code=on_code, engine=engine)
+        log_latency()
+
+        log("⚖️ Judge: Validando...")
+        verdict = judge_code(draft)
+        for issue in verdict["issues"]: log(f"⚖️ {issue}")
+        if verdict["needs_llm"]:
+            from src.gemini_client import LLMError  # o cliente já foi importado por quem chama
+            # Judge local não resolveu (sintaxe inválida ou df mock): cai para o judge LLM
+            log("⚖️ Judge LLM: revisando...")
+            try:
+                reviewed = gemini.validate_code_safety(draft, step_description, on_code=on_code)
+            except LLMError as e:
+                log(f"⚖️ Judge LLM indisponível ({e}); mantendo o veredito local.")
+            else:
+                verdict = judge_code(reviewed)
+                log_latency()
+                for issue in verdict["issues"]: log(f"⚖️ {issue}")
+        if verdict["status"] != "ok":
+            # Código que reatribui df com mock ou não parseia não chega à célula
+            log(f"❌ Judge: código descartado ({verdict['status']}).")
+            logger.error(f"Código descartado pelo judge ({verdict['status']}): {step_description[:80]}")
+            return "", []
+        final_code = verdict["code"]
+
+        log("📦 Checando deps...")
+        return final_code, self.check_missing_dependencies(final_code)
+
     def get_specific_functions_code(self, function_titles):
         selected_code = []
         titles_lower = [t.lower().strip() for t in function_titles]
@@ -37,81 +1326,369 @@ class BackendOrchestrator:
                 selected_code.append(f"# KB: {func.get('titulo')}\n{func.get('codigo_funcao')}\n")
         return "\n".join(selected_code)
 
-    def generate_metadata(self, df):
+    # --- Ingestão (cache colunar por hash do conteúdo) ---
+    def _excel_engine(self):
+        # calamine (Rust) lê xlsx muito mais rápido que openpyxl, se estiver instalado
+        if importlib.util.find_spec("python_calamine") is not None: return "calamine"
+        return None
+
+    def list_sheets(self, file_bytes, file_name):
+        if file_name.lower().endswith('.csv'): return []
+        try:
+            # ExcelFile só lê a estrutura do arquivo, sem parsear as planilhas
+            return pd.ExcelFile(io.BytesIO(file_bytes), engine=self._excel_engine()).sheet_names
+        except Exception as e:
+            logger.warning(f"Erro ao listar planilhas: {e}")
+            return []
+
+    def _ingest_key(self, file_bytes, file_name, sheet_name):
+        digest = hashlib.sha256(file_bytes).hexdigest()
+        if file_name.lower().endswith('.csv'): return digest, digest
+        if isinstance(sheet_name, int):
+            # sheet_name=0 e o nome da mesma planilha são o mesmo conteúdo: uma chave só
+            sheets = self.list_sheets(file_bytes, file_name)
+            if 0 <= sheet_name < len(sheets): sheet_name = sheets[sheet_name]
+        return digest, f"{digest}_{hashlib.sha1(str(sheet_name).encode()).hexdigest()[:12]}"
+
+    def _evict_ingest_cache(self, keep=None):
+        """
+        Apaga os arquivos menos usados (mtime, atualizado a cada acerto) até caber em
+        ingest_cache_mb. Arquivos com prefixo `keep` (o que acabou de ser gravado) ficam.
+        """
+        ingest_dir = os.path.join(self.cache_dir, "ingest")
         try:
-            buffer = io.StringIO()
-            df.info(buf=buffer)
-            return f"Shape: {df.shape}\nCols: {list(df.columns)}\nInfo: {buffer.getvalue()}\nHead:\n{df.head(3).to_string()}"
-        except: return str(df.shape)
+            files = [e for e in os.scandir(ingest_dir) if e.is_file() and not e.name.endswith(".tmp")]
+        except OSError:
+            return
+        stats = sorted((st.st_mtime, st.st_size, e.path) for e in files for st in [e.stat()])
+        total, limit = sum(size for _, size, _ in stats), self.ingest_cache_mb * 1024 * 1024
+        for _, size, path in stats:
+            if total <= limit: break
+            if keep and path.startswith(keep): continue
+            try:
+                os.remove(path)
+                total -= size
+                logger.info(f"Cache de ingestão: removido {os.path.basename(path)[:12]} ({size / 1e6:.1f} MB)")
+            except OSError: pass
+
+    def load_dataset_shared(self, file_bytes, file_name, sheet_name=0):
+        """
+        Como load_dataset, mas o frame vem do SharedStore: sessões que enviam o mesmo
+        conteúdo recebem o mesmo objeto. Retorna (df, lease); a sessão deve manter o
+        lease enquanto usar o frame.
+        """
+        _, key = self._ingest_key(file_bytes, file_name, sheet_name)
+        return self.store.acquire_frame(key, lambda: self.load_dataset(file_bytes, file_name, sheet_name)[0])
+
+    def load_dataset(self, file_bytes, file_name, sheet_name=0):
+        """
+        Carrega CSV/Excel a partir dos bytes enviados. A primeira leitura é convertida
+        para Parquet em disco; uploads repetidos do mesmo conteúdo leem do cache.
+        Retorna (df, hash_do_conteudo).
+        """
+        digest, key = self._ingest_key(file_bytes, file_name, sheet_name)
+        cache_base = os.path.join(self.cache_dir, "ingest", key)
+
+        for ext, reader in ((".parquet", pd.read_parquet), (".pkl", pd.read_pickle)):
+            if os.path.exists(cache_base + ext):
+                try:
+                    logger.info(f"Cache de ingestão: {file_name} ({key[:12]})")
+                    df = reader(cache_base + ext)
+                except Exception as e:
+                    logger.warning(f"Cache de ingestão corrompido, relendo arquivo: {e}")
+                    continue
+                try: os.utime(cache_base + ext)  # mtime = último uso (ordem de despejo)
+                except OSError: pass
+                return df, digest
+
+        if file_name.lower().endswith(".csv"):
+            df = pd.read_csv(io.BytesIO(file_bytes))
+        else:
+            # sheet_name único: as demais planilhas não são parseadas
+            df = pd.read_excel(io.BytesIO(file_bytes), sheet_name=sheet_name, engine=self._excel_engine())
+
+        os.makedirs(os.path.dirname(cache_base), exist_ok=True)
+        try:
+            df.to_parquet(f"{cache_base}.tmp")
+            os.replace(f"{cache_base}.tmp", f"{cache_base}.parquet")
+        except Exception as e:
+            # Colunas object com tipos mistos (ex: int + 'Not available') não viram Arrow;
+            # nesse caso o cache é gravado em pickle, que preserva o frame exato
+            logger.info(f"Parquet indisponível ({e}); usando cache pickle.")
+            try:
+                df.to_pickle(f"{cache_base}.tmp")
+                os.replace(f"{cache_base}.tmp", f"{cache_base}.pkl")
+            except Exception as e2:
+                logger.warning(f"Não foi possível gravar cache de ingestão: {e2}")
+        self._evict_ingest_cache(keep=cache_base)
+        return df, digest
+
+    def resolve_data_path(self, path):
+        """Caminho absoluto dentro de data_root (relativos são relativos a ela); fora dela levanta PermissionError."""
+        if not self.data_root: raise PermissionError("Leitura por caminho desativada (defina TCD_DATA_ROOT).")
+        root = os.path.realpath(self.data_root)
+        full = os.path.realpath(os.path.join(root, os.path.expanduser(path)))
+        if os.path.commonpath([root, full]) != root:
+            raise PermissionError(f"Caminho fora da pasta de dados permitida: {path}")
+        if not os.path.exists(full): raise FileNotFoundError(f"Caminho não encontrado: {path}")
+        return full
+
+    def load_lazy_dataset(self, file_bytes=None, file_name=None, sheet_name=0, path=None):
+        """
+        Motor 'arrow': registra o arquivo como LazyDataset. CSV é convertido para Parquet
+        em streaming (uma vez por conteúdo, em cache_dir/datasets/<chave>); Parquet é
+        aberto direto. `path` evita passar arquivos grandes pela memória (upload).
+        """
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+        import pyarrow.dataset as pa_ds
+
+        if path: path = self.resolve_data_path(path)
+        name = file_name or os.path.basename(path.rstrip("/"))
+        lower = name.lower()
+        if path and (lower.endswith(".parquet") or os.path.isdir(path)):
+            return open_dataset(path)
+
+        if path:
+            # Sem hash do conteúdo (dezenas de GB): caminho + tamanho + mtime
+            st = os.stat(path)
+            key = hashlib.sha256(f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}|{sheet_name}".encode()).hexdigest()
+        else:
+            _, key = self._ingest_key(file_bytes, name, sheet_name)
+        out_dir = os.path.join(self.cache_dir, "datasets", key)
+        if not os.path.isdir(out_dir):
+            tmp_dir = f"{out_dir}.tmp"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if lower.endswith(".parquet"):
+                import pyarrow.parquet as pq
+                pa_ds.write_dataset(pq.read_table(pa.BufferReader(file_bytes)), tmp_dir, format="parquet")
+            elif lower.endswith(".csv"):
+                try:
+                    # Bloco grande: a inferência de tipos do Arrow olha só o primeiro bloco
+                    reader = pa_csv.open_csv(path or pa.BufferReader(file_bytes), read_options=pa_csv.ReadOptions(block_size=64 << 20))
+                    pa_ds.write_dataset(reader, tmp_dir, format="parquet",
+                                        max_rows_per_file=5_000_000, max_rows_per_group=500_000)
+                except pa.ArrowInvalid as e:
+                    # Tipo inferido no primeiro bloco não vale para o resto do arquivo
+                    logger.warning(f"Leitura em streaming falhou ({e}); convertendo via pandas.")
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    self._write_lazy_from_pandas(pd.read_csv(path or io.BytesIO(file_bytes)), tmp_dir)
+            else:
+                # Excel não tem leitura em streaming: passa pelo pandas uma única vez
+                logger.warning("Excel no motor arrow é lido inteiro em memória na primeira carga.")
+                df = pd.read_excel(path or io.BytesIO(file_bytes), sheet_name=sheet_name, engine=self._excel_engine())
+                self._write_lazy_from_pandas(df, tmp_dir)
+            os.replace(tmp_dir, out_dir)
+        else:
+            logger.info(f"Cache de dataset Arrow: {name} ({key[:12]})")
+        return LazyDataset(pa_ds.dataset(out_dir, format="parquet"), source=name)
+
+    @staticmethod
+    def _write_lazy_from_pandas(df, out_dir):
+        import pyarrow.dataset as pa_ds
+        pa_ds.write_dataset(arrow_table(df, preserve_index=False), out_dir, format="parquet")
+
+    def profile_dataset(self, df):
+        if isinstance(df, LazyDataset): return df.profile(sample_size=self.profiler.sample_size)
+        return self.profiler.profile(df)
+
+    def generate_metadata(self, df, profile=None):
+        try:
+            profile = profile or self.profile_dataset(df)
+            lines = [
+                f"- {name}: {st['dtype']} | nulos={st['nulls']} | {DatasetProfiler.summarize_column(st)}"
+                for name, st in profile["columns"].items()
+            ]
+            engine = "Motor: arrow (LazyDataset fora da memória)\n" if isinstance(df, LazyDataset) else ""
+            return f"{engine}Shape: {df.shape}\nColunas (dtype | nulos | resumo):\n" + "\n".join(lines) + f"\nHead:\n{df.head(3).to_string()}"
+        except Exception as e:
+            logger.warning(f"Erro ao gerar metadados: {e}")
+            return str(df.shape)
 
     def check_missing_dependencies(self, code_str):
         # Tenta parsear. Se der SyntaxError, loga e retorna vazio (deixa estourar na execução)
-        try: tree = ast.parse(code_str)
+        try: return self.deps.missing(code_str)
         except SyntaxError as e:
             logger.warning(f"Erro de sintaxe ao checar deps: {e}")
             return []
-            
-        imports = set()
-        for node in ast.walk(tree):
-            if isinstance(node, ast.Import):
-                for n in node.names: imports.add(n.name.split('.')[0])
-            elif isinstance(node, ast.ImportFrom):
-                if node.module: imports.add(node.module.split('.')[0])
-        
-        std_libs = {'json','os','sys','io','re','logging','subprocess','ast','math','random','typing','warnings','time','collections','copy','pathlib'}
-        sys_libs = set(sys.builtin_module_names)
-        
-        missing = []
-        for lib in imports:
-            if lib not in sys_libs and lib not in std_libs:
-                # Verifica se a spec existe
-                if importlib.util.find_spec(lib) is None: 
-                    missing.append(lib)
-        return list(set(missing))
+
+    def kb_missing_dependencies(self):
+        return sorted(m for m in self.kb_imports if not self.deps.is_available(m))
+
+    def install_libraries_async(self, libraries):
+        """Instala em background; acompanhe `job.logs` / `job.status`."""
+        return self.deps.install(libraries)
 
     def install_libraries(self, libraries):
-        try:
-            subprocess.check_call([sys.executable, "-m", "pip", "install"] + libraries)
-            return True, "Instalado com sucesso."
-        except Exception as e: return False, str(e)
+        job = self.deps.install(libraries)
+        job.done.wait()
+        if job.ok: return True, "Instalado com sucesso."
+        return False, "\n".join(job.logs[-20:])
+
+    def execute_cached(self, code_str, df, cache, input_fp=None, render=False, task_id=None):
+        """
+        execute_code com cache de resultados. Retorna dict com df, fig, error, stdout,
+        displays, input_fp, output_fp e cached. Erros não são cacheados.
+        Com `render`, o dict traz "rendered" (itens de render_output para displays, fig e
+        df); figuras e displays vivos são descartados e não ficam presos no cache.
+        """
+        input_fp = input_fp or frame_fingerprint(df)
+        key = ResultCache.make_key(code_str, input_fp)
+        hit = cache.get(key)
+        if hit is not None:
+            self.last_run_stats = {"result_cache_hit": True}
+            return dict(hit, input_fp=input_fp, cached=True)
+
+        res_df, fig, err, out, displays = self.execute_code(code_str, df, task_id=task_id)
+        result = {"df": res_df, "fig": fig, "error": err, "stdout": out, "displays": displays}
+        if render: self._render_result(result)
+        if err is None:
+            # Só DataFrames seguem adiante na cadeia; outros resultados mantêm o fingerprint de entrada
+            result["output_fp"] = frame_fingerprint(res_df) if isinstance(res_df, FRAME_TYPES) else input_fp
+            cache.put(key, result)
+        return dict(result, input_fp=input_fp, cached=False)
+
+    def _render_result(self, result):
+        result["rendered"] = {
+            "displays": [render_output(o, self.render_max_rows) for o in result["displays"] or []],
+            "fig": render_output(result["fig"], self.render_max_rows) if result["fig"] is not None else None,
+            "df": (render_output(result["df"], self.render_max_rows)
+                   if result["error"] is None and isinstance(result["df"], FRAME_TYPES) else None),
+        }
+        result["fig"], result["displays"] = None, []
+
+    def wants_preview(self, df):
+        return self.preview_rows > 0 and isinstance(df, pd.DataFrame) and len(df) > self.preview_rows
+
+    def execute_preview(self, code_str, df, render=False, task_id=None):
+        """
+        Roda a célula numa amostra de df (preview_rows linhas, estratificada ou head) para
+        acusar erros e problemas de formato em segundos. Nada vai para o cache de
+        resultados: o resultado definitivo vem de start_full_run.
+        """
+        sample = sample_frame(df, self.preview_rows, self.preview_strategy)
+        res_df, fig, err, out, displays = self.execute_code(code_str, sample, task_id=task_id)
+        result = {"df": res_df, "fig": fig, "error": err, "stdout": out, "displays": displays,
+                  "cached": False, "preview": True, "sample_rows": len(sample), "total_rows": len(df),
+                  "warnings": [], "input_fp": None, "output_fp": None}
+        if err is None:
+            if not isinstance(res_df, FRAME_TYPES):
+                result["warnings"].append(f"a célula trocou df por {type(res_df).__name__}")
+            elif len(res_df) == 0 and len(sample):
+                result["warnings"].append("df ficou vazio na amostra")
+        if render: self._render_result(result)
+        result["stats"] = self.last_run_stats
+        return result
+
+    def start_full_run(self, code_str, df, cache, input_fp=None, render=False, task_id=None):
+        """execute_cached em uma thread; retorna o BackgroundRun (ver `done` / `result`). Cancelável por `task_id`."""
+        run = BackgroundRun(code_str, task_id)
+
+        def target():
+            try:
+                r = self.execute_cached(code_str, df, cache, input_fp=input_fp, render=render, task_id=task_id)
+                run.result = dict(r, stats=self.last_run_stats)
+            except Exception as e:
+                run.result = {"df": None, "fig": None, "error": str(e), "stdout": "", "displays": [],
+                              "rendered": {}, "cached": False, "input_fp": input_fp, "output_fp": None, "stats": {}}
+            finally:
+                run.finished = time.perf_counter()
+                run.done.set()
+        threading.Thread(target=target, daemon=True, name="tcd-full-run").start()
+        return run
+
+    def run_cells(self, codes, df, cache, on_result=None, render=False):
+        """
+        Executa a cadeia de células em ordem a partir de df. Células cujo código e
+        entrada não mudaram são servidas do cache; para no primeiro erro.
+        """
+        results = []
+        cur, fp = df, None
+        for i, code in enumerate(codes):
+            if not code:
+                results.append(None)
+                continue
+            r = self.execute_cached(code, cur, cache, input_fp=fp, render=render)
+            results.append(r)
+            if on_result: on_result(i, r)
+            if r["error"]: break
+            if isinstance(r["df"], FRAME_TYPES): cur, fp = r["df"], r["output_fp"]
+        return results
+
+    @property
+    def can_cancel(self):
+        # Só o pool consegue interromper uma célula (encerrando o worker)
+        return self.pool is not None
 
-    def execute_code(self, code_str, df):
-        local_scope = {"df": df.copy(), "fig": None}
+    def cancel(self, task_id):
+        return self.pool.cancel(task_id) if self.pool is not None else False
+
+    def execute_code(self, code_str, df, task_id=None):
+        if self.pool is not None:
+            self.last_run_stats = {}
+            profile = self.profile_top_n if self.profiling else None
+            return self.pool.execute(code_str, df, task_id=task_id, stats=self.last_run_stats, profile=profile)
+        with _EXEC_LOCK:
+            return self._execute_local(code_str, df)
+
+    def _execute_local(self, code_str, df):
+        stats = {"cold_start_s": 0.0}
+        t0 = time.perf_counter()
+        if self.namespace is None:
+            self.namespace = ExecutionNamespace(kb_library=self.kb_library)
+            stats["cold_start_s"] = self.namespace.cold_start_s
+        self.kb_library.refresh()
+        imports_before = dict(self.namespace.import_times)
+
+        # Com copy-on-write a cópia rasa isola o df da sessão sem duplicar memória
+        # _LazyGlobals também nos locals: LOAD_NAME (nível do módulo) só consulta
+        # __missing__ no mapeamento de locals; funções definidas na célula usam os globals
+        local_scope = _LazyGlobals({"df": _shallow(df), "fig": None}, kb_library=self.kb_library)
         captured_displays = []
 
         def custom_display(obj):
             captured_displays.append(obj)
 
-        exec_globals = {
-            "pd": pd, 
-            "__builtins__": __builtins__,
-            "display": custom_display
-        }
-        
-        try:
-            import numpy as np; exec_globals["np"] = np
-            import matplotlib.pyplot as plt; exec_globals["plt"] = plt
-            import seaborn as sns; exec_globals["sns"] = sns
-            import plotly.express as px; exec_globals["px"] = px
-            import plotly.graph_objects as go; exec_globals["go"] = go
-        except: pass
-        
         f_stdout = io.StringIO()
-        
+        self.last_run_stats = stats
+        figs_before = _open_figures()
+
         try:
-            with redirect_stdout(f_stdout):
-                exec(code_str, exec_globals, local_scope)
-            
+            code_obj, stats["compile_cache_hit"] = self.namespace.compile(code_str)
+            exec_globals = self.namespace.new_globals(custom_display)
+            stats["setup_s"] = time.perf_counter() - t0
+
+            profiler = CellProfiler(self.profile_top_n) if self.profiling else None
+            if profiler: profiler.start(df)
+            t_exec = time.perf_counter()
+            try:
+                with redirect_stdout(f_stdout):
+                    exec(code_obj, exec_globals, local_scope)
+            finally:
+                stats["exec_s"] = time.perf_counter() - t_exec
+                if profiler: stats["profile"] = profiler.stop()
+                stats["imports"] = {m: t for m, t in self.namespace.import_times.items() if m not in imports_before}
+            logger.info(f"Execução: setup {stats['setup_s']*1000:.1f} ms (cache={stats['compile_cache_hit']}), exec {stats['exec_s']*1000:.1f} ms, imports {stats['imports']}")
+
             captured_output = f_stdout.getvalue()
             res_df = local_scope.get('df')
-            if res_df is None: res_df = df.copy()
-            
-            return res_df, local_scope.get('fig'), None, captured_output, captured_displays
+            if res_df is None: res_df = _shallow(df)
+            if profiler: profiler.finish(res_df)
+
+            # Figuras sem atribuição (plt.hist, plot_* sem `fig =`) também saem como display,
+            # para serem renderizadas e fechadas em vez de ficarem abertas no pyplot
+            fig = local_scope.get('fig')
+            shown = {id(_matplotlib_figure(o)) for o in captured_displays + [fig] if o is not None}
+            captured_displays += [f for f in _new_figures(figs_before) if id(f) not in shown]
+            return res_df, fig, None, captured_output, captured_displays
             
         except ModuleNotFoundError as e:
             # --- CORREÇÃO CRÍTICA ---
             # Se falhar aqui por falta de lib, retornamos um erro especial
             # Formato: "No module named 'networkx'" -> extrai 'networkx'
+            # O processo pode ter instalado o pacote depois (worker do pool): a próxima tentativa enxerga
+            importlib.invalidate_caches()
+            _new_figures(figs_before, close=True)
             try:
                 missing_lib = str(e).split("'")[-2]
                 return None, None, f"MissingDependency:{missing_lib}", f_stdout.getvalue(), []
@@ -119,4 +1696,5 @@ class BackendOrchestrator:
                 return None, None, str(e), f_stdout.getvalue(), []
                 
         except Exception as e:
+            _new_figures(figs_before, close=True)
             return None, None, str(e), f_stdout.getvalue(), []
\ No newline at end of file
@@ -0,0 +1,221 @@
+"""
+Execução sem interface: salva um plano (passos + código das células) e o reexecuta
+contra uma pasta de CSV/XLSX em paralelo.
+
+    python -m src.batch_runner generate --dataset data_test/titanic.csv --objective "..." --plan plano.json
+    python -m src.batch_runner run --plan plano.json --input extracts/ --output resultados/ --workers 4
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+from src.backend import BackendOrchestrator, ResultCache, trim_plan, split_plan_steps
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DATASET_EXTENSIONS = (".csv", ".xlsx", ".xls")
+
+
+# --- Plano ---
+def build_plan(objective, cells, model_name=None):
+    return {
+        "objective": objective,
+        "model": model_name,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "cells": [{"step": c["step"], "code": c.get("code", "")} for c in cells],
+    }
+
+
+def save_plan(path, objective, cells, model_name=None):
+    plan = build_plan(objective, cells, model_name)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(plan, f, ensure_ascii=False, indent=2)
+    return plan
+
+
+def load_plan(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_dataset(backend, path, sheet_name=0):
+    with open(path, "rb") as f:
+        df, _ = backend.load_dataset(f.read(), os.path.basename(path), sheet_name=sheet_name)
+    return df
+
+
+def generate_plan(dataset_path, objective, plan_path, model_name="gemini-2.5-flash-lite", concurrency=4):
+    """Gera plano e código de todas as células a partir de um dataset de referência."""
+    from src.gemini_client import GeminiClient, PromptCache, LLMError
+
+    backend = BackendOrchestrator()
+    gemini = GeminiClient(model_name=model_name, cache=PromptCache())
+    df = read_dataset(backend, dataset_path)
+    meta = backend.generate_metadata(df)
+
+    steps = split_plan_steps(trim_plan(gemini.generate_initial_plan(objective, meta)))
+    logger.info(f"Plano com {len(steps)} passos")
+    cells = [{"step": s, "code": ""} for s in steps]
+
+    def gen(i):
+        try:
+            code, missing = backend.generate_code_for_step(
+                gemini, steps[i], objective, meta, log=lambda msg: logger.info(f"[passo {i+1}] {msg}")
+            )
+        except LLMError as e:
+            # Célula vazia no plano: as demais continuam e o passo pode ser regerado depois
+            logger.error(f"[passo {i+1}] {e}")
+            return i, ""
+        if missing: logger.warning(f"[passo {i+1}] Dependências ausentes: {missing}")
+        return i, code
+
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        for fut in as_completed([ex.submit(gen, i) for i in range(len(steps))]):
+            i, code = fut.result()
+            cells[i]["code"] = code
+    return save_plan(plan_path, objective, cells, model_name)
+
+
+# --- Execução ---
+def _save_frame(df, path_base):
+    try:
+        df.to_parquet(f"{path_base}.parquet")
+        return f"{path_base}.parquet"
+    except Exception:
+        # Tipos mistos em colunas object não viram Arrow
+        df.to_pickle(f"{path_base}.pkl")
+        return f"{path_base}.pkl"
+
+
+def _save_figure(fig, path_base):
+    if hasattr(fig, "write_html"):  # plotly
+        fig.write_html(f"{path_base}.html")
+        return f"{path_base}.html"
+    fig = getattr(fig, "figure", fig)  # Axes -> Figure
+    if hasattr(fig, "savefig"):
+        fig.savefig(f"{path_base}.png", bbox_inches="tight")
+        try:
+            import matplotlib.pyplot as plt
+            plt.close(fig)
+        except Exception: pass
+        return f"{path_base}.png"
+    return None
+
+
+def run_plan_on_dataset(plan, dataset_path, output_dir):
+    """Executa as células do plano em ordem e grava resultado, figuras e stdout em output_dir."""
+    os.makedirs(output_dir, exist_ok=True)
+    backend = BackendOrchestrator()
+    t0 = time.perf_counter()
+    summary = {"dataset": dataset_path, "cells": [], "error": None}
+    try:
+        df = read_dataset(backend, dataset_path)
+    except Exception as e:
+        summary["error"] = f"Erro ao ler dataset: {e}"
+        return summary
+
+    final_df = df
+
+    def on_result(i, r):
+        nonlocal final_df
+        prefix = os.path.join(output_dir, f"passo_{i+1:02d}")
+        cell = {"index": i + 1, "error": r["error"], "outputs": []}
+        if r["stdout"]:
+            with open(f"{prefix}_stdout.txt", "w", encoding="utf-8") as f: f.write(r["stdout"])
+            cell["outputs"].append(f"{prefix}_stdout.txt")
+        for j, obj in enumerate(r["displays"] or []):
+            base = f"{prefix}_display_{j+1:02d}"
+            if isinstance(obj, (pd.DataFrame, pd.Series)):
+                obj.to_csv(f"{base}.csv")
+                cell["outputs"].append(f"{base}.csv")
+            elif hasattr(obj, "savefig") or hasattr(obj, "write_html") or hasattr(obj, "figure"):
+                saved = _save_figure(obj, base)
+                if saved: cell["outputs"].append(saved)
+            else:
+                with open(f"{base}.txt", "w", encoding="utf-8") as f: f.write(repr(obj))
+                cell["outputs"].append(f"{base}.txt")
+        if r["fig"] is not None:
+            saved = _save_figure(r["fig"], f"{prefix}_fig")
+            if saved: cell["outputs"].append(saved)
+        if r["error"] is None and isinstance(r["df"], pd.DataFrame): final_df = r["df"]
+        summary["cells"].append(cell)
+
+    codes = [c.get("code", "") for c in plan["cells"]]
+    backend.run_cells(codes, df, ResultCache(max_entries=len(codes) or 1), on_result=on_result)
+    summary["result"] = _save_frame(final_df, os.path.join(output_dir, "resultado"))
+    summary["error"] = next((c["error"] for c in summary["cells"] if c["error"]), None)
+    summary["elapsed_s"] = time.perf_counter() - t0
+    return summary
+
+
+def _run_one(args):
+    # Top-level para ser serializável pelo ProcessPoolExecutor
+    plan, dataset_path, output_dir = args
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    return run_plan_on_dataset(plan, dataset_path, output_dir)
+
+
+def run_batch(plan_path, input_dir, output_dir, workers=None):
+    """Roda o plano em todos os datasets de input_dir (um processo por arquivo, até `workers`)."""
+    plan = load_plan(plan_path)
+    files = sorted(
+        os.path.join(input_dir, name) for name in os.listdir(input_dir)
+        if name.lower().endswith(DATASET_EXTENSIONS)
+    )
+    # Pasta com a extensão (x.csv/, x.xlsx/): arquivos de mesmo nome não sobrescrevem um ao outro
+    jobs = [(plan, path, os.path.join(output_dir, os.path.basename(path))) for path in files]
+    logger.info(f"{len(jobs)} datasets, {workers or os.cpu_count()} processos")
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        futures = {ex.submit(_run_one, job): job[1] for job in jobs}
+        for fut in as_completed(futures):
+            try: res = fut.result()
+            except Exception as e: res = {"dataset": futures[fut], "error": str(e), "cells": []}
+            status = "❌ " + res["error"] if res.get("error") else "✅"
+            logger.info(f"{os.path.basename(res['dataset'])}: {status}")
+            results.append(res)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2, default=str)
+    return results
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="TCD - execução de planos em lote")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="Gera plano + código das células a partir de um dataset")
+    gen.add_argument("--dataset", required=True)
+    gen.add_argument("--objective", required=True)
+    gen.add_argument("--plan", required=True, help="Arquivo JSON de saída")
+    gen.add_argument("--model", default="gemini-2.5-flash-lite")
+    gen.add_argument("--concurrency", type=int, default=4)
+
+    run = sub.add_parser("run", help="Executa um plano salvo em uma pasta de datasets")
+    run.add_argument("--plan", required=True)
+    run.add_argument("--input", required=True, help="Pasta com CSV/XLSX")
+    run.add_argument("--output", required=True)
+    run.add_argument("--workers", type=int, default=None)
+
+    args = parser.parse_args(argv)
+    if args.command == "generate":
+        generate_plan(args.dataset, args.objective, args.plan, args.model, args.concurrency)
+    else:
+        results = run_batch(args.plan, args.input, args.output, args.workers)
+        return 1 if any(r.get("error") for r in results) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
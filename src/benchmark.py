@@ -0,0 +1,404 @@
+"""
+Benchmark offline do pipeline (sem rede): ingestão, perfil/metadados, KB (carga e
+seleção), checagem de dependências, geração com LLM simulado e execução de funções da KB.
+O GeminiClient é substituído por um stub determinístico com respostas gravadas, então
+os números medem só o custo local. Os datasets de data_test/ também são ampliados
+sinteticamente (--rows) para medir o comportamento com 1M+ linhas.
+
+    python -m src.benchmark --output bench.json
+    python -m src.benchmark --rows 1000000 --only ingest,profile --baseline bench.json
+
+Saída em JSON: uma entrada por medição com tempo (mín/mediana), pico de memória
+(tracemalloc) e shape do dataset. Com --baseline, medições mais lentas que a
+tolerância viram regressões e o processo sai com código 1.
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from src.backend import BackendOrchestrator, DatasetProfiler, SharedStore, trim_plan, split_plan_steps
+
+logger = logging.getLogger(__name__)
+
+GROUPS = ("ingest", "profile", "kb", "deps", "generate", "execute")
+
+# --- Respostas gravadas: (passo, funções da KB, código gerado) ---
+SCENARIOS = {
+    "titanic": {
+        "path": "data_test/titanic.csv",
+        "objective": "Entender os fatores associados à sobrevivência dos passageiros",
+        "steps": [
+            ("Calcular estatísticas descritivas da coluna Age", ["calculate_descriptive_statistics"],
+             "stats = calculate_descriptive_statistics(df, 'Age')\ndisplay(pd.DataFrame([stats]))"),
+            ("Imputar valores ausentes de Age pela mediana", ["impute_missing_values_simple"],
+             "df = impute_missing_values_simple(df, cols=['Age'], strategy='median')\ndisplay(df.head())"),
+            ("Identificar outliers de Fare pelo método IQR", ["find_outlier_indices"],
+             "idx = find_outlier_indices(df, cols=['Fare'], method='iqr')\nprint(f'Outliers: {len(idx)}')\ndisplay(df.loc[idx].head())"),
+            ("Codificar as colunas categóricas Sex e Embarked", ["encode_categorical"],
+             "df = encode_categorical(df, cols=['Sex', 'Embarked'], method='onehot')\ndisplay(df.head())"),
+            ("Plotar histograma da distribuição de Fare", ["plot_histogram"],
+             "ax = plot_histogram(df, 'Fare')\nfig = ax.figure"),
+            ("Plotar mapa de calor de correlação das variáveis numéricas", ["plot_correlation_heatmap"],
+             "ax = plot_correlation_heatmap(df, cols=['Survived', 'Pclass', 'Age', 'SibSp', 'Parch', 'Fare'])\nfig = ax.figure"),
+        ],
+    },
+    "credit": {
+        "path": "data_test/default_of_credit_card.xlsx",
+        "objective": "Analisar o perfil dos clientes inadimplentes",
+        "steps": [
+            ("Calcular estatísticas descritivas de LIMIT_BAL", ["calculate_descriptive_statistics"],
+             "stats = calculate_descriptive_statistics(df, 'LIMIT_BAL')\ndisplay(pd.DataFrame([stats]))"),
+            ("Identificar outliers de BILL_AMT1 e PAY_AMT1 pelo método IQR", ["find_outlier_indices"],
+             "idx = find_outlier_indices(df, cols=['BILL_AMT1', 'PAY_AMT1'], method='iqr')\nprint(f'Outliers: {len(idx)}')"),
+            ("Codificar EDUCATION e MARRIAGE com one-hot", ["encode_categorical"],
+             "df = encode_categorical(df, cols=['EDUCATION', 'MARRIAGE'], method='onehot')\ndisplay(df.head())"),
+            ("Plotar contagem da variável alvo default payment next month", ["plot_countplot"],
+             "ax = plot_countplot(df, 'default payment next month')\nfig = ax.figure"),
+            ("Plotar boxplot de LIMIT_BAL por SEX", ["plot_boxplot_by_category"],
+             "ax = plot_boxplot_by_category(df, 'SEX', 'LIMIT_BAL')\nfig = ax.figure"),
+        ],
+    },
+}
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class RecordedModel:
+    """Substitui genai.GenerativeModel: responde pelo tipo de prompt com as respostas gravadas."""
+    def __init__(self, scenario, chunk_size=64):
+        self.scenario = scenario
+        self.chunk_size = chunk_size
+
+    def _respond(self, prompt):
+        steps = self.scenario["steps"]
+        if "Crie um plano" in prompt:
+            return "\n".join(f"{i}. {step}" for i, (step, _, _) in enumerate(steps, 1))
+        for step, funcs, code in steps:
+            if step not in prompt: continue
+            if "Retorne JSON" in prompt: return json.dumps({"funcoes_escolhidas": funcs})
+            return f"```python\n{code}\n```"
+        return "```python\ndisplay(df.head())\n```"
+
+    def generate_content(self, prompt, stream=False):
+        text = self._respond(prompt)
+        if not stream: return _Chunk(text)
+        return (_Chunk(text[i:i + self.chunk_size]) for i in range(0, len(text), self.chunk_size))
+
+
+def make_stub_client(scenario, cache=None, prompt_budget_tokens=6000):
+    """GeminiClient real (montagem de prompt, streaming, extração) sobre o RecordedModel."""
+    from src.gemini_client import GeminiClient, TokenBucket
+    # Sem limite de taxa nem retry: a latência medida é só a do pipeline
+    return GeminiClient(model_name="recorded", model=RecordedModel(scenario), cache=cache,
+                        prompt_budget_tokens=prompt_budget_tokens, limiter=TokenBucket(rate_per_min=0), max_retries=0)
+
+
+# --- Datasets ---
+def scale_frame(df, n_rows, seed=0):
+    """Amplia df para n_rows sorteando linhas com reposição; colunas float ganham ruído leve."""
+    rng = np.random.default_rng(seed)
+    out = df.iloc[rng.integers(0, len(df), n_rows)].reset_index(drop=True)
+    for col in out.select_dtypes("float").columns:
+        out[col] = out[col] * rng.normal(1.0, 0.01, n_rows)
+    return out
+
+
+def load_datasets(backend, names, rows):
+    """Retorna [(rótulo, cenário, bytes, nome_arquivo, df)] com os originais e, se rows, as versões ampliadas."""
+    datasets = []
+    for name in names:
+        path = SCENARIOS[name]["path"]
+        with open(path, "rb") as f: raw = f.read()
+        df, _ = backend.load_dataset(raw, os.path.basename(path))
+        datasets.append((name, name, raw, os.path.basename(path), df))
+        if rows:
+            big = scale_frame(df, rows)
+            # Ampliados sempre em CSV: gravar xlsx de 1M linhas levaria minutos
+            datasets.append((f"{name}_x{rows}", name, big.to_csv(index=False).encode("utf-8"), f"{name}_{rows}.csv", big))
+    return datasets
+
+
+# --- Medição ---
+def _summary(extra, max_items=20):
+    """Só campos escalares (e listas/dicts curtos de escalares): o JSON guarda um resumo, não o resultado."""
+    scalar = (bool, int, float, str, type(None))
+    out = {}
+    for k, v in extra.items():
+        if isinstance(v, scalar): out[k] = v
+        elif isinstance(v, (list, tuple)) and len(v) <= max_items and all(isinstance(x, scalar) for x in v): out[k] = list(v)
+        elif isinstance(v, dict) and len(v) <= max_items and all(isinstance(x, scalar) for x in v.values()): out[k] = dict(v)
+    return out
+
+
+def _profile_summary(profile):
+    cols = profile["columns"].values()
+    return {"columns": len(profile["columns"]), "approx_columns": sum(1 for st in cols if st.get("approx"))}
+
+
+class Bench:
+    def __init__(self, repeat=3, memory=True):
+        self.repeat = repeat
+        self.memory = memory
+        self.results = []
+
+    def measure(self, name, run, setup=None, dataset=None, df=None, repeat=None):
+        """
+        Roda `setup()` (fora do tempo) e `run(estado)` `repeat` vezes; o pico de memória
+        vem de uma rodada extra sob tracemalloc, para não distorcer os tempos. Se `run`
+        devolver um dict com "error", a medição é marcada como falha (tempo de um erro não
+        é tempo da operação).
+        """
+        setup = setup or (lambda: None)
+        times, extra = [], None
+        for _ in range(repeat or self.repeat):
+            state = setup()
+            gc.collect()
+            t0 = time.perf_counter()
+            extra = run(state)
+            times.append(time.perf_counter() - t0)
+
+        peak_mb = None
+        if self.memory:
+            state = setup()
+            gc.collect()
+            tracemalloc.start()
+            try: run(state)
+            finally:
+                peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+                tracemalloc.stop()
+
+        entry = {
+            "name": name, "dataset": dataset,
+            "rows": None if df is None else int(df.shape[0]), "cols": None if df is None else int(df.shape[1]),
+            "wall_s_min": min(times), "wall_s_median": statistics.median(times), "repeat": len(times),
+            "peak_mb": peak_mb,
+        }
+        if isinstance(extra, dict):
+            error = extra.get("error")
+            if error:
+                entry["failed"] = True
+                entry["error"] = str(error).splitlines()[0][:200]
+            entry["extra"] = _summary({k: v for k, v in extra.items() if k != "error"})
+        self.results.append(entry)
+        mem = f" | pico {peak_mb:.1f} MB" if peak_mb is not None else ""
+        if entry.get("failed"):
+            logger.warning(f"{name} [{dataset or '-'}] FALHOU: {entry['error']}")
+            return entry
+        logger.info(f"{name} [{dataset or '-'}]: {entry['wall_s_median']*1000:.1f} ms{mem}")
+        return entry
+
+
+def bench_ingest(bench, datasets, tmp):
+    for name, _, raw, file_name, df in datasets:
+        def cold():
+            # Diretório de cache novo a cada rodada: mede o parse + gravação do cache
+            cache_dir = tempfile.mkdtemp(dir=tmp)
+            return BackendOrchestrator(cache_dir=cache_dir, store=SharedStore())
+        bench.measure("ingest:parse", lambda b: b.load_dataset(raw, file_name),
+                      setup=cold, dataset=name, df=df)
+
+        warm = cold()
+        warm.load_dataset(raw, file_name)
+        bench.measure("ingest:cache_hit", lambda _: warm.load_dataset(raw, file_name), dataset=name, df=df)
+        if not file_name.lower().endswith(".csv"):
+            bench.measure("ingest:list_sheets", lambda _: warm.list_sheets(raw, file_name), dataset=name, df=df)
+
+
+def bench_profile(bench, backend, datasets):
+    for name, _, _, _, df in datasets:
+        bench.measure("profile:cold", lambda p: _profile_summary(p.profile(df)), setup=DatasetProfiler, dataset=name, df=df)
+
+        warm = DatasetProfiler()
+        warm.profile(df)
+        bench.measure("profile:warm", lambda _: _profile_summary(warm.profile(df)), dataset=name, df=df)
+
+        # Passo típico: uma coluna nova; só ela deve ser recalculada
+        changed = df.assign(__bench_col=np.arange(len(df)))
+        bench.measure("profile:one_new_column", lambda _: _profile_summary(warm.profile(changed)), dataset=name, df=changed)
+
+        profile = warm.profile(df)
+        bench.measure("metadata:generate", lambda _: backend.generate_metadata(df, profile), dataset=name, df=df)
+
+
+def bench_kb(bench, kb_path, tmp, scenarios):
+    def fresh(index_dir):
+        return lambda: BackendOrchestrator(kb_path=kb_path, cache_dir=index_dir, store=SharedStore())
+    # Sem índice em disco: parse do jsonl + construção do BM25 + biblioteca
+    bench.measure("kb:load_cold", lambda f: f(), setup=lambda: fresh(tempfile.mkdtemp(dir=tmp)))
+    warm_dir = tempfile.mkdtemp(dir=tmp)
+    fresh(warm_dir)()
+    bench.measure("kb:load_index_cached", lambda f: f(), setup=lambda: fresh(warm_dir))
+
+    backend = fresh(warm_dir)()
+    steps = [step for sc in scenarios for step, _, _ in sc["steps"]]
+
+    def select_all(_):
+        hits = sum(1 for step in steps if backend.select_kb_candidates(step)[1])
+        return {"steps": len(steps), "local_hits": hits}
+    bench.measure("kb:select", select_all)
+
+    # Compilação preguiçosa das funções da KB (primeiro acesso vs já compiladas)
+    titles = sorted({f for sc in scenarios for _, funcs, _ in sc["steps"] for f in funcs})
+    bench.measure("kb:compile_functions", lambda lib: [lib.get(t) for t in titles],
+                  setup=lambda: fresh(warm_dir)().kb_library)
+
+
+def bench_deps(bench, backend, scenarios):
+    codes = [code for sc in scenarios for _, _, code in sc["steps"]]
+    kb_codes = [f.get("codigo_funcao", "") for f in backend.knowledge_base]
+    for name, batch in (("deps:cells", codes), ("deps:kb_functions", kb_codes)):
+        def run(_, batch=batch):
+            missing = {lib for c in batch for lib in backend.check_missing_dependencies(c)}
+            return {"codes": len(batch), "missing": sorted(missing)}
+        # Frio: cache de resolução limpo (como logo após uma instalação); quente: já resolvido
+        bench.measure(f"{name}_cold", run, setup=backend.deps.invalidate)
+        bench.measure(name, run)
+
+
+def bench_generate(bench, backend, datasets):
+    for name, scenario_name, _, _, df in datasets:
+        scenario = SCENARIOS[scenario_name]
+        meta = backend.generate_metadata(df)
+
+        def run(gemini):
+            steps = split_plan_steps(trim_plan(gemini.generate_initial_plan(scenario["objective"], meta)))
+            for step in steps:
+                backend.generate_code_for_step(gemini, step, scenario["objective"], meta)
+            tokens = {m["stage"]: m["prompt_tokens"] for m in gemini.latencies}
+            return {"steps": len(steps), "llm_calls": len(gemini.latencies), "prompt_tokens_by_stage": tokens}
+        # LLM com latência zero: o tempo é só montagem de prompt, seleção, judge e deps
+        bench.measure("generate:pipeline", run, setup=lambda: make_stub_client(scenario), dataset=name, df=df)
+
+
+def _close_figures():
+    # Fora do tempo medido: figuras abertas de uma rodada não pesam na seguinte
+    try:
+        import matplotlib.pyplot as plt
+        plt.close("all")
+    except Exception: pass
+
+
+def bench_execute(bench, backend, datasets):
+    for name, scenario_name, _, _, df in datasets:
+        scenario = SCENARIOS[scenario_name]
+        for step, funcs, code in scenario["steps"]:
+            backend.execute_code(code, df)  # aquecimento: imports e compilação fora da medição
+
+            def run(_, code=code):
+                _, _, err, _, _ = backend.execute_code(code, df)
+                stats = dict(backend.last_run_stats, error=err)
+                stats.pop("imports", None)
+                return stats
+            bench.measure(f"execute:{funcs[0]}", run, setup=_close_figures, dataset=name, df=df)
+
+
+# --- Comparação com execução anterior ---
+def compare(results, baseline, tolerance):
+    """
+    Lista as medições cuja mediana ficou mais de `tolerance` (fração) acima do baseline.
+    Uma célula que passava e agora falha também é regressão; falhas no baseline não servem de referência.
+    """
+    base = {(r["name"], r["dataset"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        old = base.get((r["name"], r["dataset"]))
+        if not old or old.get("failed") or not old["wall_s_median"]: continue
+        if r.get("failed"):
+            regressions.append({"name": r["name"], "dataset": r["dataset"], "ratio": None,
+                                "baseline_s": old["wall_s_median"], "current_s": None, "error": r["error"]})
+            continue
+        ratio = r["wall_s_median"] / old["wall_s_median"]
+        if ratio > 1 + tolerance:
+            regressions.append({"name": r["name"], "dataset": r["dataset"], "ratio": ratio,
+                                "baseline_s": old["wall_s_median"], "current_s": r["wall_s_median"]})
+    return regressions
+
+
+def run_benchmarks(groups=GROUPS, datasets=tuple(SCENARIOS), rows=1_000_000, repeat=3, memory=True, kb_path="data/kb.jsonl"):
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    tmp = tempfile.mkdtemp(prefix="tcd_bench_")
+    bench = Bench(repeat=repeat, memory=memory)
+    try:
+        backend = BackendOrchestrator(kb_path=kb_path, cache_dir=tmp, store=SharedStore())
+        data = load_datasets(backend, datasets, rows)
+        scenarios = [SCENARIOS[n] for n in datasets]
+
+        if "ingest" in groups: bench_ingest(bench, data, tmp)
+        if "profile" in groups: bench_profile(bench, backend, data)
+        if "kb" in groups: bench_kb(bench, kb_path, tmp, scenarios)
+        if "deps" in groups: bench_deps(bench, backend, scenarios)
+        if "generate" in groups: bench_generate(bench, backend, data)
+        if "execute" in groups: bench_execute(bench, backend, data)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return {
+        "meta": {
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": sys.version.split()[0], "pandas": pd.__version__, "numpy": np.__version__,
+            "platform": platform.platform(), "cpu_count": os.cpu_count(),
+            "rows": rows, "repeat": repeat, "memory": memory, "groups": list(groups),
+        },
+        "results": bench.results,
+    }
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    # Os logs por chamada do backend/LLM/matplotlib poluiriam a saída e o próprio tempo medido
+    for name in ("src.backend", "src.gemini_client", "matplotlib"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description="TCD - benchmark offline (LLM simulado)")
+    parser.add_argument("--output", default="bench.json", help="Arquivo JSON de saída")
+    parser.add_argument("--only", default=",".join(GROUPS), help=f"Grupos separados por vírgula: {','.join(GROUPS)}")
+    parser.add_argument("--datasets", default=",".join(SCENARIOS))
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Linhas dos datasets ampliados (0 = só os originais)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="Não mede pico de memória (tracemalloc)")
+    parser.add_argument("--kb", default="data/kb.jsonl")
+    parser.add_argument("--baseline", default=None, help="JSON de uma execução anterior para comparar")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Folga relativa antes de acusar regressão")
+    parser.add_argument("--allow-failures", action="store_true", help="Não retorna erro quando alguma célula falha")
+    args = parser.parse_args(argv)
+
+    groups = [g.strip() for g in args.only.split(",") if g.strip()]
+    unknown = set(groups) - set(GROUPS)
+    if unknown: parser.error(f"Grupos desconhecidos: {', '.join(sorted(unknown))}")
+
+    report = run_benchmarks(groups, [d.strip() for d in args.datasets.split(",") if d.strip()],
+                            args.rows, args.repeat, not args.no_memory, args.kb)
+    failed = [r for r in report["results"] if r.get("failed")]
+    status = 1 if failed and not args.allow_failures else 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f: baseline = json.load(f)
+        report["regressions"] = compare(report["results"], baseline, args.tolerance)
+        for r in report["regressions"]:
+            if r["ratio"] is None:
+                logger.warning(f"Regressão: {r['name']} [{r['dataset'] or '-'}] passou a falhar ({r['error']})")
+            else:
+                logger.warning(f"Regressão: {r['name']} [{r['dataset'] or '-'}] {r['ratio']:.2f}x ({r['baseline_s']*1000:.1f} → {r['current_s']*1000:.1f} ms)")
+        if report["regressions"]: status = 1
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    logger.info(f"{len(report['results'])} medições em {args.output}" + (f" ({len(failed)} com falha)" if failed else ""))
+    return status
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
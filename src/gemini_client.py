@@ -3,27 +3,432 @@ import os
 import logging
 import json
 import re  # Importante para a correção
+import sqlite3
+import hashlib
+import threading
+import time
+import random
+import ast
+import textwrap
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class PromptCache:
+    """
+    Cache persistente (SQLite) de respostas do LLM, chaveado por modelo + hash do prompt
+    normalizado. Entradas expiram após `ttl_s` e as menos usadas são removidas acima de `max_entries`.
+    """
+    def __init__(self, path=".cache/llm_cache.sqlite", max_entries=5000, ttl_s=7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, last_access REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+
+    @staticmethod
+    def make_key(model_name, prompt):
+        # Só a indentação comum do template e espaços no fim das linhas: a indentação do
+        # código embutido (judge, fix) faz parte do prompt e precisa mudar a chave
+        normalized = "\n".join(line.rstrip() for line in textwrap.dedent(prompt).strip().splitlines())
+        return hashlib.sha256(f"{model_name}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, model_name, prompt):
+        key = self.make_key(model_name, prompt)
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] <= self.ttl_s:
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return row[0]
+            if row: self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self.misses += 1
+        return None
+
+    def put(self, model_name, prompt, response):
+        key = self.make_key(model_name, prompt)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, model_name, response, now, now),
+            )
+            self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_s,))
+            count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def estimate_tokens(text):
+    # Aproximação offline (~4 caracteres por token); evita uma chamada count_tokens por prompt
+    return (len(text or "") + 3) // 4
+
+
+_META_COL = re.compile(r"^- (.+?): (\S+) \| nulos=(\d+) \| (.*)$")
+
+
+def compress_metadata(df_metadata, level):
+    """
+    Compacta os metadados de BackendOrchestrator.generate_metadata.
+    0 = completo; 1 = sem Head; 2 = colunas agrupadas por dtype (nome e nulos);
+    3 = como 2, limitado a 30 colunas por dtype.
+    """
+    if level <= 0 or not df_metadata: return df_metadata
+    text = df_metadata.split("\nHead:")[0]
+    if level == 1: return text
+
+    header, groups, other = [], {}, []
+    for line in text.splitlines():
+        m = _META_COL.match(line)
+        if m:
+            name, dtype, nulls = m.group(1), m.group(2), int(m.group(3))
+            groups.setdefault(dtype, []).append(f"{name} (nulos={nulls})" if nulls else name)
+        elif line.startswith("Colunas"):
+            continue
+        elif not groups:
+            header.append(line)
+        else:
+            other.append(line)
+    if not groups: return text
+    out = header + ["Colunas por dtype:"]
+    for dtype, names in groups.items():
+        shown = names if level == 2 else names[:30]
+        extra = f", ... (+{len(names) - len(shown)})" if len(names) > len(shown) else ""
+        out.append(f"- {dtype} ({len(names)}): {', '.join(shown)}{extra}")
+    return "\n".join(out + other)
+
+
+def compress_kb_code(kb_code, level):
+    """
+    Compacta o código das funções da KB. 0 = fonte completa;
+    1 = assinatura + docstring; 2 = só assinatura.
+    """
+    if level <= 0 or not kb_code: return kb_code
+    try: tree = ast.parse(kb_code)
+    except SyntaxError: return kb_code
+    stubs = []
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)): continue
+        returns = f" -> {ast.unparse(node.returns)}" if node.returns else ""
+        stub = f"def {node.name}({ast.unparse(node.args)}){returns}:"
+        doc = ast.get_docstring(node)
+        if level == 1 and doc:
+            doc_body = doc.replace("\n", "\n    ")
+            stub += f'\n    """{doc_body}"""'
+        stubs.append(stub + "\n    ...")
+    return "\n\n".join(stubs) if stubs else kb_code
+
+
+class CodeStreamExtractor:
+    """
+    Versão incremental de GeminiClient._extract_code: recebe os chunks do stream e
+    devolve o código parcial (conteúdo do primeiro bloco ``` aberto, ou o texto cru).
+    """
+    def __init__(self):
+        self.buffer = ""
+        self.start = None
+        self.end = None
+
+    def feed(self, chunk):
+        scan_from = max(len(self.buffer) - 3, 0)
+        self.buffer += chunk
+        if self.start is None:
+            fence = self.buffer.find("```")
+            if fence < 0:
+                # Sem bloco até agora: texto é tratado como código (se não parecer início de fence)
+                return "" if self.buffer.lstrip().startswith("`") else self.buffer.rstrip("`").strip()
+            newline = self.buffer.find("\n", fence)
+            if newline < 0: return ""  # ainda lendo a linha ```python
+            self.start = newline + 1
+            scan_from = self.start
+        if self.end is None:
+            close = self.buffer.find("```", max(scan_from, self.start))
+            if close >= 0: self.end = close
+        code = self.buffer[self.start:self.end]
+        # Remove crases parciais do fechamento que ainda não chegou por completo
+        return code.rstrip("`").rstrip()
+
+
+# --- Transporte: erros tipados, limite de taxa compartilhado, retry e coalescência ---
+class LLMError(Exception):
+    """Falha na chamada ao LLM (depois dos retries, se o erro era transitório)."""
+    retryable = False
+
+    def __init__(self, message, stage=None, attempts=1):
+        super().__init__(message)
+        self.stage = stage
+        self.attempts = attempts
+
+
+class LLMRateLimitError(LLMError):
+    """429 / cota excedida, ou o limite local não liberou a chamada a tempo."""
+    retryable = True
+
+
+class LLMUnavailableError(LLMError):
+    """Erro transitório do serviço: 5xx, timeout, conexão."""
+    retryable = True
+
+
+class LLMRequestError(LLMError):
+    """Erro definitivo: chave inválida, argumento inválido, resposta bloqueada."""
+
+
+_RATE_LIMIT_ERRORS = {"ResourceExhausted", "TooManyRequests"}
+_TRANSIENT_ERRORS = {"ServiceUnavailable", "InternalServerError", "DeadlineExceeded", "GatewayTimeout",
+                     "BadGateway", "ServerError", "RetryError"}
+
+
+def classify_error(e):
+    """Classe de LLMError correspondente a uma exceção do SDK (sem depender de google.api_core)."""
+    name, code = type(e).__name__, getattr(e, "code", None)
+    code = getattr(code, "value", code)  # grpc.StatusCode
+    if name in _RATE_LIMIT_ERRORS or code == 429 or "429" in str(e)[:200]: return LLMRateLimitError
+    if name in _TRANSIENT_ERRORS or code in (500, 502, 503, 504) or isinstance(e, (ConnectionError, TimeoutError)):
+        return LLMUnavailableError
+    return LLMRequestError
+
+
+class TokenBucket:
+    """
+    Limite de taxa por processo (compartilhado entre sessões que usam a mesma chave).
+    `rate_per_min` <= 0 desativa. `pause` segura todas as chamadas após um 429.
+    """
+    def __init__(self, rate_per_min=60, burst=None):
+        self.rate = rate_per_min / 60.0
+        self.capacity = burst or max(1.0, rate_per_min / 10.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        if self.rate <= 0: return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                wait = max(self._paused_until - now, 0.0)
+                if not wait and self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = wait or (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline: return False
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class InflightRequests:
+    """Prompts idênticos em andamento (várias sessões/threads) viram uma única chamada."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def run(self, key, fn):
+        """Retorna (resultado, compartilhado). Só a primeira chamada executa `fn`; as demais esperam."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader: call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None: raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock: self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False
+
+
+SHARED_LIMITER = TokenBucket(rate_per_min=float(os.getenv("TCD_LLM_RPM", "60")))
+SHARED_INFLIGHT = InflightRequests()
+
+
+# Regra extra do prompt de código por motor de dados (ver src/lazy_dataset.py)
+ENGINE_RULES = {
+    "pandas": "",
+    "arrow": """5. MOTOR ARROW (fora da memória): `df` NÃO é pandas.DataFrame, é um LazyDataset. Use:
+           `df.filter(pc.field("col") > 10)`, `df.select("a", "b")`, `df.aggregate({"col": "mean"}, by="grupo")`,
+           `df.value_counts("col")`, `df.head(n)`, `len(df)`. Para funções do KB ou gráficos, materialize só o
+           necessário: `df.sample(100_000)` ou `df.filter(...).select(...).to_pandas()`. `pc` = pyarrow.compute.
+           Para mudar o df da sessão, atribua um LazyDataset a `df` (nunca o dataset inteiro em pandas).""",
+}
+
+
 class GeminiClient:
-    def __init__(self, model_name="gemini-2.5-flash-lite"):
+    # (nível metadados, nível KB) do menos para o mais compacto. As funções da KB já
+    # existem no ambiente de execução, então o prompt nunca leva o corpo delas.
+    COMPRESSION_LEVELS = [(0, 1), (1, 1), (2, 1), (3, 1), (3, 2)]
+
+    def __init__(self, model_name="gemini-2.5-flash-lite", cache=None, prompt_budget_tokens=6000,
+                 limiter=None, max_retries=4, model=None):
         self.api_key = os.getenv("GEMINI_API_KEY", "YOUR_API_KEY")
         genai.configure(api_key=self.api_key)
         self.model_name = model_name
-        self.model = genai.GenerativeModel(self.model_name)
+        # `model` injetado (ex: respostas gravadas do benchmark) substitui o genai.GenerativeModel
+        self.model = model or genai.GenerativeModel(self.model_name)
+        self.cache = cache
+        # True = ignora o cache na leitura (regeneração forçada); a resposta nova ainda é gravada
+        self.bypass_cache = False
+        self.streaming = True
+        self.prompt_budget_tokens = prompt_budget_tokens
+        # Latência por etapa (plan, select, write, judge, fix); last_metrics é por thread
+        self.latencies = []
+        self._local = threading.local()
+        # Limite de taxa e coalescência são do processo (mesma chave de API em todas as sessões)
+        self.limiter = limiter or SHARED_LIMITER
+        self.inflight = SHARED_INFLIGHT
+        self.max_retries = max_retries
+        self.backoff_base_s = 1.0
+        self.backoff_max_s = 30.0
+        # Tempo máximo esperando o limite local antes de desistir com LLMRateLimitError
+        self.limiter_timeout_s = 120.0
 
     def set_model(self, model_name):
         self.model_name = model_name
         self.model = genai.GenerativeModel(self.model_name)
 
-    def _generate_text(self, prompt):
+    def last_metrics(self):
+        """Métricas da última chamada feita nesta thread: stage, ttft_s, total_s, cached."""
+        return getattr(self._local, "metrics", None)
+
+    def _record(self, stage, t0, t_first, cached, prompt_tokens):
+        now = time.perf_counter()
+        metrics = {"stage": stage, "ttft_s": (t_first or now) - t0, "total_s": now - t0,
+                   "cached": cached, "prompt_tokens": prompt_tokens}
+        self._local.metrics = metrics
+        self.latencies.append(metrics)
+        logger.info(f"LLM [{stage}] ~{prompt_tokens} tokens | TTFT {metrics['ttft_s']:.2f}s | total {metrics['total_s']:.2f}s | cache={cached}")
+
+    def _fit_prompt(self, render, df_metadata="", kb_code=""):
+        """
+        Monta o prompt dentro de prompt_budget_tokens: `render(metadados, kb)` é chamado
+        com níveis crescentes de compactação até caber (ou até o nível mais compacto).
+        """
+        prompt = ""
+        for meta_level, kb_level in self.COMPRESSION_LEVELS:
+            prompt = render(compress_metadata(df_metadata, meta_level), compress_kb_code(kb_code, kb_level))
+            if estimate_tokens(prompt) <= self.prompt_budget_tokens: break
+        return prompt
+
+    def _fit_text(self, text, max_tokens, keep="tail"):
+        # Corta texto livre (ex: traceback) mantendo o início ou o fim
+        max_chars = max_tokens * 4
+        if len(text or "") <= max_chars: return text
+        return ("..." + text[-max_chars:]) if keep == "tail" else (text[:max_chars] + "...")
+
+    def _generate_text(self, prompt, stage="other", on_chunk=None):
+        """
+        Gera texto do modelo. Com `streaming` ativo, `on_chunk(texto_acumulado)` é chamado
+        a cada pedaço recebido. Registra TTFT e latência total da etapa.
+        Prompts idênticos em andamento são coalescidos; falhas levantam LLMError.
+        """
+        t0 = time.perf_counter()
+        if self.cache is not None and not self.bypass_cache:
+            cached = self.cache.get(self.model_name, prompt)
+            if cached is not None:
+                if on_chunk: on_chunk(cached)
+                self._record(stage, t0, None, True, estimate_tokens(prompt))
+                return cached
+        key = PromptCache.make_key(self.model_name, prompt)
         try:
-            response = self.model.generate_content(prompt)
-            return response.text if response else ""
-        except Exception as e:
-            return f"# Erro API: {e}"
+            (text, t_first), shared = self.inflight.run(key, lambda: self._call_with_retry(prompt, stage, on_chunk))
+        except LLMError:
+            # Erros nunca vão para o cache
+            self._record(stage, t0, None, False, estimate_tokens(prompt))
+            raise
+        if shared:
+            # Quem esperou a chamada de outra sessão recebe o texto pronto de uma vez
+            t_first = None
+            if on_chunk and text: on_chunk(text)
+        self._record(stage, t0, t_first, False, estimate_tokens(prompt))
+        if self.cache is not None and text and not shared:
+            try: self.cache.put(self.model_name, prompt, text)
+            except Exception as e: logger.warning(f"Falha ao gravar cache do LLM: {e}")
+        return text
+
+    def _call_with_retry(self, prompt, stage, on_chunk):
+        """Chama o modelo respeitando o limite de taxa; erros transitórios têm retry com backoff exponencial + jitter."""
+        for attempt in range(self.max_retries + 1):
+            if not self.limiter.acquire(timeout=self.limiter_timeout_s):
+                raise LLMRateLimitError(f"Limite local de requisições ({stage}) não liberou em {self.limiter_timeout_s:.0f}s",
+                                        stage=stage, attempts=attempt)
+            emitted = []
+            try:
+                return self._request(prompt, on_chunk, emitted)
+            except Exception as e:
+                error_cls = classify_error(e)
+                # Stream já exibido parcialmente não é refeito: o texto mostrado ficaria inconsistente
+                if not error_cls.retryable or emitted or attempt == self.max_retries:
+                    raise error_cls(f"{type(e).__name__}: {e}", stage=stage, attempts=attempt + 1) from e
+                delay = random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * 2 ** attempt))
+                # 429 vale para a chave inteira: segura todas as sessões, não só esta
+                if error_cls is LLMRateLimitError: self.limiter.pause(delay)
+                logger.warning(f"LLM [{stage}] {type(e).__name__}; tentativa {attempt + 1}/{self.max_retries + 1}, nova tentativa em {delay:.1f}s")
+                time.sleep(delay)
+
+    def _request(self, prompt, on_chunk, emitted):
+        # Uma chamada ao modelo; retorna (texto, instante do primeiro pedaço)
+        t_first = None
+        if self.streaming:
+            parts = []
+            for chunk in self.model.generate_content(prompt, stream=True):
+                piece = getattr(chunk, "text", "") or ""
+                if not piece: continue
+                if t_first is None: t_first = time.perf_counter()
+                parts.append(piece)
+                if on_chunk:
+                    emitted.append(True)
+                    on_chunk("".join(parts))
+            return "".join(parts), t_first
+        response = self.model.generate_content(prompt)
+        return (response.text if response else ""), time.perf_counter()
+
+    def _stream_code(self, on_code):
+        # Adapta on_code(codigo_parcial) para o on_chunk(texto_acumulado) de _generate_text
+        if on_code is None: return None
+        extractor = CodeStreamExtractor()
+        state = {"seen": 0}
+
+        def on_chunk(text):
+            new = text[state["seen"]:]
+            state["seen"] = len(text)
+            on_code(extractor.feed(new))
+        return on_chunk
 
     def _extract_code(self, text):
         """
@@ -43,15 +448,15 @@ class GeminiClient:
         # Se não tiver bloco, retorna o texto inteiro (assumindo que é só código)
         return text.strip()
 
-    def generate_initial_plan(self, user_objective, df_metadata):
-        prompt = f"""
+    def generate_initial_plan(self, user_objective, df_metadata, on_chunk=None):
+        prompt = self._fit_prompt(lambda meta, _: f"""
         Atue como Arquiteto de Dados.
         Objetivo: {user_objective}
-        Metadados: {df_metadata}
+        Metadados: {meta}
         Crie um plano de EDA (Análise Exploratória) em Markdown.
         Sem introduções. Apenas lista numerada.
-        """
-        return self._generate_text(prompt)
+        """, df_metadata=df_metadata)
+        return self._generate_text(prompt, stage="plan", on_chunk=on_chunk)
 
     def select_relevant_functions(self, step_description, kb_metadata_list):
         kb_text = "\n".join([f"- {item['titulo']}: {item['descricao']}" for item in kb_metadata_list])
@@ -60,7 +465,12 @@ class GeminiClient:
         KB: {kb_text}
         Retorne JSON: {{ "funcoes_escolhidas": ["Titulo1"] }}
         """
-        res = self._generate_text(prompt)
+        try:
+            res = self._generate_text(prompt, stage="select")
+        except LLMError as e:
+            # Seleção é opcional: sem ela a célula é escrita sem funções da KB
+            logger.warning(f"Seleção da KB indisponível: {e}")
+            return []
         try:
             # Limpeza específica para JSON
             clean = res.replace("```json", "").replace("```", "").strip()
@@ -68,25 +478,26 @@ class GeminiClient:
         except:
             return []
 
-    def generate_final_code(self, step_description, user_objective, df_metadata, relevant_functions_code):
-        prompt = f"""
+    def generate_final_code(self, step_description, user_objective, df_metadata, relevant_functions_code, on_code=None, engine="pandas"):
+        prompt = self._fit_prompt(lambda meta, kb: f"""
         Expert Python Data Science.
         Objetivo: {user_objective}
         Passo: {step_description}
-        Metadados: {df_metadata}
-        KB Contexto: {relevant_functions_code}
+        Metadados: {meta}
+        KB Contexto: {kb}
         
         **REGRAS:**
         1. `df` JÁ EXISTE e já está carregado. NÃO recrie. Use a variável `df` que já existe.
         2. USE `display(df)` para mostrar tabelas (NÃO use print).
         3. NÃO crie dados manuais (`data = {{...}}`).
-        
+        4. As funções do KB Contexto JÁ ESTÃO DISPONÍVEIS no ambiente (com seus imports). Chame-as diretamente; NÃO as redefina nem copie.
+        {ENGINE_RULES.get(engine, "")}
         Gere apenas Python.
-        """
-        res = self._generate_text(prompt)
+        """, df_metadata=df_metadata, kb_code=relevant_functions_code)
+        res = self._generate_text(prompt, stage="write", on_chunk=self._stream_code(on_code))
         return self._extract_code(res) # Usa o extrator seguro
 
-    def validate_code_safety(self, generated_code, step_description):
+    def validate_code_safety(self, generated_code, step_description, on_code=None):
         prompt = f"""
         Judge Python. Passo: "{step_description}"
         Código:
@@ -99,17 +510,20 @@ class GeminiClient:
         
         Retorne Python corrigido.
         """
-        res = self._generate_text(prompt)
+        res = self._generate_text(prompt, stage="judge", on_chunk=self._stream_code(on_code))
         return self._extract_code(res) # Usa o extrator seguro
 
-    def generate_code_fix(self, broken_code, error_msg, step):
+    def generate_code_fix(self, broken_code, error_msg, step, on_code=None, engine="pandas"):
+        # Tracebacks longos: o fim (onde está a exceção) é o que importa
+        error_msg = self._fit_text(str(error_msg), self.prompt_budget_tokens // 4)
         prompt = f"""
         Corrija o código.
         Passo: {step}
         Erro: {error_msg}
         Código:
         {broken_code}
+        {ENGINE_RULES.get(engine, "")}
         Retorne Python corrigido.
         """
-        res = self._generate_text(prompt)
+        res = self._generate_text(prompt, stage="fix", on_chunk=self._stream_code(on_code))
         return self._extract_code(res) # Usa o extrator seguro
\ No newline at end of file
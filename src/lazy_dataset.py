@@ -0,0 +1,239 @@
+"""
+Motor fora da memória: o arquivo vira um dataset Arrow (Parquet em disco) e as células
+recebem um LazyDataset em vez de um pandas.DataFrame. Filtros e projeções descem para o
+scan; agregações, contagens e o perfil são calculados lote a lote, sem carregar o
+arquivo inteiro. Só o que a célula pedir explicitamente (head, sample, to_pandas) é
+materializado em pandas.
+"""
+import hashlib
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+logger = logging.getLogger(__name__)
+
+# Agregações combináveis lote a lote (mean = sum / count)
+_PARTIALS = {"sum": ("sum",), "count": ("count",), "min": ("min",), "max": ("max",), "mean": ("sum", "count")}
+
+
+class LazyDataset:
+    """
+    Visão preguiçosa de um dataset Arrow: `select`/`filter` devolvem novas visões sem ler
+    dados; `head`, `aggregate`, `value_counts`, `sample` e `to_pandas` executam o scan.
+    Imutável: cópias são desnecessárias e a mesma visão pode ser compartilhada.
+    """
+    engine = "arrow"
+
+    def __init__(self, dataset, columns=None, filter=None, source=None):
+        self._dataset = dataset
+        self._columns = list(columns) if columns is not None else None
+        self._filter = filter
+        self.source = source
+        self._rows = None
+        self._profile = None
+
+    def __reduce__(self):
+        # Picklável (pool de workers, cache de resultados): só caminhos + visão
+        return (LazyDataset, (self._dataset, self._columns, self._filter, self.source))
+
+    def __repr__(self):
+        where = f", filtro={self._filter}" if self._filter is not None else ""
+        return f"LazyDataset({self.source or 'arrow'}: {len(self.columns)} colunas{where})"
+
+    # --- Estrutura ---
+    @property
+    def schema(self):
+        schema = self._dataset.schema
+        if self._columns is None: return schema
+        return pa.schema([schema.field(c) for c in self._columns])
+
+    @property
+    def columns(self):
+        return list(self.schema.names)
+
+    @property
+    def dtypes(self):
+        return pd.Series({f.name: str(f.type) for f in self.schema}, dtype=object)
+
+    @property
+    def shape(self):
+        if self._rows is None:
+            # Sem filtro, o Parquet responde pelos metadados (sem ler os dados)
+            self._rows = self._dataset.count_rows(filter=self._filter)
+        return (self._rows, len(self.columns))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def fingerprint(self):
+        # Tamanho e mtime de cada arquivo: Parquet regravado no mesmo caminho muda o fingerprint
+        files = getattr(self._dataset, "files", None) or []
+        try:
+            infos = self._dataset.filesystem.get_file_info(files) if files else []
+            files = [(i.path, i.size, i.mtime_ns) for i in infos]
+        except Exception as e:
+            logger.warning(f"Sem metadados dos arquivos para o fingerprint: {e}")
+        return hashlib.sha256(repr((files, self._columns, str(self._filter))).encode("utf-8")).hexdigest()
+
+    # --- Visões (sem leitura) ---
+    def select(self, *columns):
+        if len(columns) == 1 and isinstance(columns[0], (list, tuple)): columns = columns[0]
+        missing = [c for c in columns if c not in self.columns]
+        if missing: raise KeyError(f"Colunas inexistentes: {missing}")
+        return LazyDataset(self._dataset, columns, self._filter, self.source)
+
+    def filter(self, expression):
+        """`expression` é uma expressão Arrow, ex: `(pc.field("Age") > 30) & (pc.field("Sex") == "male")`."""
+        combined = expression if self._filter is None else (self._filter & expression)
+        return LazyDataset(self._dataset, self._columns, combined, self.source)
+
+    def __getitem__(self, key):
+        if isinstance(key, str): return self.select(key)
+        if isinstance(key, (list, tuple)): return self.select(*key)
+        if isinstance(key, pc.Expression): return self.filter(key)
+        raise TypeError("Use df['col'], df[['a', 'b']] ou df[pc.field('col') > valor].")
+
+    # --- Scans ---
+    def to_batches(self, columns=None, batch_size=131_072):
+        return self._dataset.to_batches(columns=columns or self._columns, filter=self._filter, batch_size=batch_size)
+
+    def scanner(self, columns=None):
+        return self._dataset.scanner(columns=columns or self._columns, filter=self._filter)
+
+    def head(self, n=5):
+        return self._dataset.head(n, columns=self._columns, filter=self._filter).to_pandas()
+
+    def to_pandas(self, max_rows=5_000_000):
+        """Materializa a visão. Acima de `max_rows` linhas levanta erro: filtre/agregue antes."""
+        if max_rows is not None and len(self) > max_rows:
+            raise MemoryError(f"{len(self)} linhas excedem max_rows={max_rows}; use filter/select/aggregate ou sample.")
+        return self.scanner().to_table().to_pandas()
+
+    def sample(self, n=100_000, seed=0):
+        """Amostra uniforme em uma passada (Bernoulli por lote)."""
+        total = len(self)
+        if total <= n: return self.to_pandas(max_rows=None)
+        frac, rng, parts = n / total, np.random.default_rng(seed), []
+        for batch in self.to_batches():
+            mask = rng.random(batch.num_rows) < frac
+            if mask.any(): parts.append(batch.filter(pa.array(mask)))
+        if not parts: return self.head(0)
+        return pa.Table.from_batches(parts, schema=parts[0].schema).to_pandas()
+
+    def aggregate(self, aggs, by=None):
+        """
+        Agregação em streaming. `aggs`: {coluna: "sum"|"mean"|"min"|"max"|"count"} ou
+        {coluna: [funções]}; `by`: coluna(s) de agrupamento. Retorna pandas.DataFrame.
+        """
+        by = [by] if isinstance(by, str) else list(by or [])
+        aggs = {c: [f] if isinstance(f, str) else list(f) for c, f in aggs.items()}
+        for funcs in aggs.values():
+            unknown = set(funcs) - set(_PARTIALS)
+            if unknown: raise ValueError(f"Agregações suportadas: {sorted(_PARTIALS)}")
+        partial_specs = sorted({(c, p) for c, funcs in aggs.items() for f in funcs for p in _PARTIALS[f]})
+
+        parts = []
+        for batch in self.to_batches(columns=list(dict.fromkeys(by + list(aggs)))):
+            table = pa.Table.from_batches([batch])
+            if by:
+                part = table.group_by(by).aggregate(partial_specs).to_pandas()
+            else:
+                fns = {"sum": pc.sum, "count": pc.count, "min": pc.min, "max": pc.max}
+                part = pd.DataFrame([{f"{c}_{p}": fns[p](table[c]).as_py() for c, p in partial_specs}])
+            parts.append(part)
+        if not parts: return pd.DataFrame(columns=by + [f"{c}_{f}" for c, funcs in aggs.items() for f in funcs])
+
+        partials = pd.concat(parts, ignore_index=True)
+        combine = {f"{c}_{p}": ("sum" if p in ("sum", "count") else p) for c, p in partial_specs}
+        merged = partials.groupby(by, dropna=False).agg(combine) if by else partials.agg(combine).to_frame().T
+
+        out = pd.DataFrame(index=merged.index)
+        for c, funcs in aggs.items():
+            for f in funcs:
+                out[f"{c}_{f}"] = merged[f"{c}_sum"] / merged[f"{c}_count"] if f == "mean" else merged[f"{c}_{f}"]
+        return out.reset_index() if by else out.reset_index(drop=True)
+
+    def value_counts(self, column, top=None):
+        # Conta linhas (mode="all"), não valores não nulos: o grupo nulo sai com o total real
+        spec = [(column, "count", pc.CountOptions(mode="all"))]
+        parts = [pa.Table.from_batches([batch]).group_by(column).aggregate(spec).to_pandas()
+                 for batch in self.to_batches(columns=[column])]
+        if not parts: return pd.Series(dtype="int64", name="count")
+        counts = pd.concat(parts, ignore_index=True).groupby(column, dropna=False)[f"{column}_count"].sum()
+        counts = counts.sort_values(ascending=False).rename("count")
+        return counts.head(top) if top else counts
+
+    def sql(self, query):
+        """SQL via DuckDB (opcional) sobre a visão; a tabela se chama `df`. Retorna pandas."""
+        try:
+            import duckdb
+        except ImportError:
+            raise ImportError("DuckDB não está instalado (pip install duckdb).")
+        con = duckdb.connect()
+        try:
+            con.register("df", self.scanner())
+            return con.execute(query).df()
+        finally:
+            con.close()
+
+    # --- Perfil em streaming ---
+    def profile(self, sample_size=100_000):
+        """
+        Mesmo formato de DatasetProfiler.profile. Contagem, nulos, média, mínimo e máximo
+        são exatos (uma passada); desvio, quantis e cardinalidade vêm de uma amostra.
+        """
+        if self._profile is not None: return self._profile
+        from src.backend import DatasetProfiler
+
+        schema = self.schema
+        total = len(self)
+        numeric = [f.name for f in schema if (pa.types.is_integer(f.type) or pa.types.is_floating(f.type) or pa.types.is_decimal(f.type))]
+        ordered = numeric + [f.name for f in schema if pa.types.is_temporal(f.type)]
+        acc = {c: {"nulls": 0, "sum": 0.0, "count": 0, "min": None, "max": None} for c in schema.names}
+
+        frac = min(1.0, sample_size / total) if total else 1.0
+        rng, sampled = np.random.default_rng(0), []
+        for batch in self.to_batches():
+            for name in schema.names:
+                col = batch.column(name)
+                a = acc[name]
+                a["nulls"] += col.null_count
+                if name in ordered and len(col) > col.null_count:
+                    mm = pc.min_max(col)
+                    lo, hi = mm["min"].as_py(), mm["max"].as_py()
+                    a["min"] = lo if a["min"] is None else min(a["min"], lo)
+                    a["max"] = hi if a["max"] is None else max(a["max"], hi)
+                if name in numeric:
+                    a["sum"] += pc.sum(col).as_py() or 0
+                    a["count"] += pc.count(col).as_py()
+            if frac < 1.0:
+                mask = rng.random(batch.num_rows) < frac
+                if mask.any(): sampled.append(batch.filter(pa.array(mask)))
+            else:
+                sampled.append(batch)
+
+        sample = (pa.Table.from_batches(sampled, schema=sampled[0].schema).to_pandas() if sampled
+                  else self.head(0))
+        profiler = DatasetProfiler(sample_threshold=float("inf"))
+        columns = {}
+        for name in schema.names:
+            st = profiler._column_stats(sample[name])
+            a = acc[name]
+            st.update(dtype=str(schema.field(name).type), count=total - a["nulls"], nulls=a["nulls"], approx=frac < 1.0)
+            if st.get("kind") == "numeric" and a["count"]:
+                st.update(mean=a["sum"] / a["count"], min=a["min"], max=a["max"])
+            elif st.get("kind") == "datetime":
+                st.update(min=a["min"], max=a["max"])
+            columns[name] = st
+        self._profile = {"shape": self.shape, "columns": columns}
+        return self._profile
+
+
+def open_dataset(path, file_format=None):
+    fmt = file_format or ("csv" if path.lower().endswith(".csv") else "parquet")
+    return LazyDataset(ds.dataset(path, format=fmt), source=os.path.basename(path.rstrip("/")))
@@ -0,0 +1,244 @@
+import multiprocessing as mp
+import threading
+import queue
+import pickle
+import logging
+import time
+import sys
+import os
+from multiprocessing import shared_memory
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# --- Troca de DataFrames via Arrow IPC em memória compartilhada ---
+def _untrack(shm):
+    # No Python < 3.13 o resource_tracker também registra blocos apenas anexados
+    # e tenta removê-los de novo ao final; quem cria é quem faz o unlink.
+    if sys.version_info < (3, 13):
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception: pass
+
+
+def _pack_df(df):
+    if df is None: return None
+    try:
+        import pyarrow as pa
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        sink = pa.MockOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as w: w.write_table(table)
+        size = sink.size()
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        buf = pa.py_buffer(shm.buf)
+        stream = pa.FixedSizeBufferWriter(buf)
+        with pa.ipc.new_stream(stream, table.schema) as w: w.write_table(table)
+        stream.close()
+        del stream, buf
+        _untrack(shm)
+        shm.close()
+        return ("shm", shm.name, size)
+    except Exception:
+        # Tipos mistos em colunas object (ou objeto que não é DataFrame): pickle protocolo 5
+        return ("pickle", pickle.dumps(df, protocol=5))
+
+
+def _unpack_df(payload, unlink=True):
+    if payload is None: return None
+    if payload[0] == "pickle": return pickle.loads(payload[1])
+
+    import pyarrow as pa
+    _, name, size = payload
+    shm = shared_memory.SharedMemory(name=name)
+    _untrack(shm)
+    try:
+        table = pa.ipc.open_stream(pa.py_buffer(shm.buf)[:size]).read_all()
+        # to_pandas copia para blocos do pandas; o bloco compartilhado pode ser liberado
+        df = table.to_pandas()
+        del table
+    finally:
+        shm.close()
+        if unlink: shm.unlink()
+    return df
+
+
+def _release(payload):
+    if payload and payload[0] == "shm":
+        try:
+            shm = shared_memory.SharedMemory(name=payload[1])
+            _untrack(shm)
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError: pass
+
+
+def default_memory_limit_mb(fraction=0.5, floor_mb=1024):
+    """Limite padrão por worker: metade da RAM física (RLIMIT_AS conta memória virtual, então não muito justo)."""
+    try:
+        total = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None  # Windows: sem RLIMIT_AS de qualquer forma
+    return max(floor_mb, int(total * fraction / 1024 ** 2))
+
+
+# --- Processo worker ---
+def _worker_main(conn, kb_path, memory_limit_mb):
+    if memory_limit_mb:
+        try:
+            import resource
+            limit = int(memory_limit_mb) * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except Exception as e:
+            logger.warning(f"Limite de memória indisponível: {e}")
+
+    import matplotlib
+    matplotlib.use("Agg")
+    from src.backend import BackendOrchestrator
+    backend = BackendOrchestrator(kb_path=kb_path)
+    # Pré-aquecimento: o custo de importar a pilha de plotagem fica fora das células
+    try:
+        import numpy, matplotlib.pyplot, seaborn, plotly.express  # noqa: F401
+    except Exception: pass
+    conn.send(("ready",))
+
+    while True:
+        try: msg = conn.recv()
+        except EOFError: break
+        if msg is None: break
+        code_str, payload, profile = msg
+        # profile: None = sem perfil; int = top N do cProfile (0 = só tempo/memória)
+        backend.profiling = profile is not None
+        backend.profile_top_n = profile or 0
+        try:
+            df = _unpack_df(payload, unlink=False)
+            res_df, fig, err, out, displays = backend.execute_code(code_str, df)
+            stats = backend.last_run_stats
+        except MemoryError:
+            stats = {}
+            res_df, fig, err, out, displays = None, None, "MemoryError: limite de memória da célula excedido", "", []
+        except Exception as e:
+            stats = {}
+            res_df, fig, err, out, displays = None, None, str(e), "", []
+
+        packed = _pack_df(res_df)
+        try:
+            conn.send(("ok", packed, fig, err, out, displays, stats))
+        except Exception as e:
+            # Figuras/objetos não serializáveis não derrubam o resultado
+            logger.warning(f"Saída não serializável: {e}")
+            conn.send(("ok", packed, None, err, out, [repr(o) for o in displays], stats))
+        try:
+            import matplotlib.pyplot as plt
+            plt.close("all")
+        except Exception: pass
+
+
+class _Worker:
+    def __init__(self, ctx, kb_path, memory_limit_mb):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, kb_path, memory_limit_mb), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def wait_ready(self, timeout=120):
+        if self.conn.poll(timeout):
+            return self.conn.recv() == ("ready",)
+        return False
+
+    def kill(self):
+        try:
+            self.process.terminate()
+            self.process.join(2)
+            if self.process.is_alive(): self.process.kill()
+        except Exception: pass
+        try: self.conn.close()
+        except Exception: pass
+
+
+class ExecutionPool:
+    """
+    Pool de processos pré-aquecidos para executar células fora do servidor Streamlit.
+    O df vai e volta como Arrow IPC em memória compartilhada; cada célula tem
+    limite de tempo (timeout_s) e, no POSIX, de memória (memory_limit_mb).
+    Um worker que estoura limites ou é cancelado é encerrado e substituído.
+    """
+    def __init__(self, n_workers=2, timeout_s=300, memory_limit_mb=None, kb_path="data/kb.jsonl"):
+        self.timeout_s = timeout_s
+        self.memory_limit_mb = memory_limit_mb
+        self.kb_path = kb_path
+        self._ctx = mp.get_context("spawn")
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._busy = {}
+        for _ in range(n_workers): self._idle.put(self._spawn())
+
+    def _spawn(self):
+        w = _Worker(self._ctx, self.kb_path, self.memory_limit_mb)
+        if not w.wait_ready(): logger.warning("Worker não confirmou inicialização a tempo.")
+        return w
+
+    def _replace(self, worker):
+        worker.kill()
+        threading.Thread(target=lambda: self._idle.put(self._spawn()), daemon=True).start()
+
+    def cancel(self, task_id):
+        """Cancela a execução `task_id` (o worker é encerrado e substituído). Retorna se ela estava rodando."""
+        with self._lock: event = self._busy.get(task_id)
+        if event: event.set()
+        return event is not None
+
+    def cancel_all(self):
+        with self._lock:
+            for event in self._busy.values(): event.set()
+
+    def execute(self, code_str, df, timeout_s=None, task_id=None, stats=None, profile=None):
+        """
+        Mesmo contrato de BackendOrchestrator.execute_code: (df, fig, erro, stdout, displays).
+        Se `stats` for um dict, recebe as métricas de tempo medidas no worker.
+        `profile` (None ou top N do cProfile) liga o perfil da célula no worker.
+        """
+        timeout_s = timeout_s or self.timeout_s
+        cancel_event = threading.Event()
+        task_id = task_id or id(cancel_event)
+        with self._lock: self._busy[task_id] = cancel_event
+
+        worker = self._idle.get()
+        if cancel_event.is_set():
+            # Cancelada enquanto esperava um worker livre
+            with self._lock: self._busy.pop(task_id, None)
+            self._idle.put(worker)
+            return None, None, "Execução cancelada.", "", []
+        payload = _pack_df(df)
+        healthy = False
+        try:
+            worker.conn.send((code_str, payload, profile))
+            deadline = time.monotonic() + timeout_s
+            while not worker.conn.poll(0.1):
+                if cancel_event.is_set():
+                    return None, None, "Execução cancelada.", "", []
+                if not worker.process.is_alive():
+                    return None, None, "Worker encerrado durante a execução (memória insuficiente?).", "", []
+                if time.monotonic() > deadline:
+                    return None, None, f"Tempo limite excedido ({timeout_s}s).", "", []
+
+            _, packed, fig, err, out, displays, run_stats = worker.conn.recv()
+            healthy = True
+            if stats is not None: stats.update(run_stats)
+            return _unpack_df(packed), fig, err, out, displays
+        except (EOFError, OSError) as e:
+            return None, None, f"Falha de comunicação com o worker: {e}", "", []
+        finally:
+            _release(payload)
+            with self._lock: self._busy.pop(task_id, None)
+            if healthy: self._idle.put(worker)
+            else: self._replace(worker)
+
+    def shutdown(self):
+        while not self._idle.empty():
+            w = self._idle.get_nowait()
+            try: w.conn.send(None)
+            except Exception: pass
+            w.kill()
@@ -0,0 +1,90 @@
+import pandas as pd
+
+from src.backend import judge_code
+
+
+def run(code):
+    # Executa o código julgado como uma célula: df de entrada e display capturado
+    shown = []
+    scope = {"pd": pd, "df": pd.DataFrame({"a": [1, 2], "b": [3, 4]}), "display": shown.append}
+    exec(code, scope)
+    return scope, shown
+
+
+def test_mock_dict_keeps_name_bound():
+    verdict = judge_code("data = {'a': [1, 2], 'b': [3, 4]}\nprint(len(data))")
+    assert verdict["status"] == "ok"
+    assert verdict["code"].startswith("data = {}\n")
+    assert "#" not in verdict["code"]
+
+
+def test_mock_frame_used_later_goes_to_llm():
+    code = "data = {'a': [1, 2]}\ndf2 = pd.DataFrame(data)\ndisplay(df2)"
+    verdict = judge_code(code)
+    assert verdict["needs_llm"]
+    # Mesmo sem o judge LLM, o código julgado não quebra com NameError
+    scope, shown = run(verdict["code"])
+    assert isinstance(scope["df2"], pd.DataFrame) and len(shown) == 1
+
+
+def test_config_dict_read_later_goes_to_llm():
+    verdict = judge_code("data = {'cols': ['a', 'b']}\nout = df[data['cols']]")
+    assert verdict["needs_llm"]
+
+
+def test_mock_removal_preserves_rest_of_line():
+    verdict = judge_code("x = pd.DataFrame({'a': [1, 2]}); print('ok')")
+    assert verdict["code"] == "x = pd.DataFrame(); print('ok')"
+    assert not verdict["needs_llm"]
+
+
+def test_mock_unused_needs_no_llm():
+    verdict = judge_code("data = {'a': [1, 2]}\ndisplay(df.describe())")
+    assert verdict["status"] == "ok" and not verdict["needs_llm"]
+    _, shown = run(verdict["code"])
+    assert len(shown) == 1
+
+
+def test_df_from_literals_is_rejected():
+    verdict = judge_code("df = pd.DataFrame({'a': [1, 2]})")
+    assert verdict["status"] == "rejected" and verdict["needs_llm"]
+
+
+def test_print_df_becomes_display():
+    verdict = judge_code("print(df.head())  # amostra\nprint(df.shape)")
+    assert verdict["code"] == "display(df.head())  # amostra\nprint(df.shape)"
+    assert not verdict["needs_llm"]
+
+
+def test_annotated_df_from_literals_is_rejected():
+    verdict = judge_code("df: pd.DataFrame = pd.DataFrame({'a': [1, 2]})")
+    assert verdict["status"] == "rejected"
+
+
+def test_tuple_target_df_from_literals_is_rejected():
+    verdict = judge_code("df, y = {'a': [1, 2]}, 2")
+    assert verdict["status"] == "rejected"
+
+
+def test_data_keyword_mock_is_removed():
+    verdict = judge_code("x = pd.DataFrame(data={'a': [1, 2]})\nprint('ok')")
+    assert verdict["code"] == "x = pd.DataFrame()\nprint('ok')"
+    assert not verdict["needs_llm"]
+    verdict = judge_code("df = pd.DataFrame(data=[[1, 2]])")
+    assert verdict["status"] == "rejected"
+
+
+def test_tuple_target_mock_keeps_other_values():
+    verdict = judge_code("x, n = pd.DataFrame({'a': [1]}), len(df)")
+    assert verdict["code"] == "x, n = pd.DataFrame(), len(df)"
+
+
+def test_print_scalar_stays_print():
+    code = "print(df.shape[0])\nprint(df['a'].mean())\nprint(df.isna().sum().sum())"
+    verdict = judge_code(code)
+    assert verdict["code"] == code
+
+
+def test_print_series_becomes_display():
+    verdict = judge_code("print(df['a'].value_counts())\nprint(df.groupby('a')['b'].mean())")
+    assert verdict["code"] == "display(df['a'].value_counts())\ndisplay(df.groupby('a')['b'].mean())"